@@ -13,6 +13,8 @@ from stockton import __version__, cli, dns
 from stockton.concur.formats.postfix import Main, SMTPd, Master
 from stockton.concur.formats.opendkim import OpenDKIM
 from stockton.concur.formats.generic import SpaceConfig
+from stockton.concur.formats.spamassassin import SpamAssassin, Local
+from stockton.concur.loader import load
 from stockton.path import Dirpath, Filepath, Sentinal
 
 from stockton.interface import SMTP, Postfix, DKIM, Spam, Razor, Pyzor, SRS, DCC
@@ -47,6 +49,7 @@ def main_configure_recv(mailserver):
 
     p = Postfix()
     cert = p.cert(mailserver)
+    cert_exists = cert.exists()
     cert.assure()
 
     settings = [
@@ -106,9 +109,9 @@ def main_configure_recv(mailserver):
 
     m = p.main()
     m.update(*settings)
-    m.save()
-
-    p.restart()
+    # only reload postfix if something it reads actually changed
+    if m.save() or not cert_exists:
+        p.restart()
 
 
 @arg('--mailserver', help='The domain mailserver (eg, mail.example.com)')
@@ -143,9 +146,8 @@ def main_configure_send(mailserver):
     # add the config to master.cf to enable smtp sending
     #m = p.master(master_bak.path)
     m = p.master()
-    for smtp in m["smtp"]:
-        if smtp.cmd == "smtpd":
-            smtp.chroot = "n"
+    for smtp in m.find_command("smtpd", "smtp"):
+        smtp.chroot = "n"
 
     m["submission"].chroot = "n"
     m["submission"].update(
@@ -189,8 +191,13 @@ def main_configure_dkim():
     if external_ip:
         dk.set_ip(external_ip)
 
+    configs = load({
+        "dkim": (OpenDKIM, dk.config_f.path),
+        "main": (Main, p.main_f.path),
+    })
+
     trustedhosts_f = dk.trustedhosts_f
-    c = dk.config()
+    c = configs["dkim"]
     c.update(
         ("Canonicalization", "relaxed/simple"),
         ("Mode", "sv"),
@@ -207,7 +214,7 @@ def main_configure_dkim():
     )
     c.save()
 
-    m = p.main()
+    m = configs["main"]
     m.update(
         ("milter_default_action", "accept"),
         # http://lists.opendkim.org/archive/opendkim/users/2011/08/1297.html
@@ -360,7 +367,12 @@ def main_delete_domain(domain):
     default="",
     help='smtp password for sending emails, will be used for each domain in proxy-domains'
 )
-def main_add_domains(proxy_domains, smtp_username, smtp_password):
+@arg(
+    '--merge',
+    action="store_true",
+    help='Compile all the domains\' addresses into one merged alias map'
+)
+def main_add_domains(proxy_domains, smtp_username, smtp_password, merge=False):
     """Given a directory containing domain alias configuration files, corresponding to
     the format specified in
 
@@ -383,13 +395,18 @@ def main_add_domains(proxy_domains, smtp_username, smtp_password):
 
     for domain, proxy_file in domains.items():
         echo.h2("Adding domain {} from file {}", domain, proxy_file)
-        main_add_domain(domain, proxy_file, "", smtp_username, smtp_password)
+        main_add_domain(domain, proxy_file, "", smtp_username, smtp_password, merge)
 
 
 @arg('domain', nargs="?", help='The email domain (eg, example.com)')
 @arg('--proxy-file', default="", help='The file containing domain addresses to proxy emails')
 @arg('--proxy-email', default="", help='The final destination email address')
-def main_update_domain_proxy(domain, proxy_file, proxy_email):
+@arg(
+    '--merge',
+    action="store_true",
+    help='Compile all the domains\' addresses into one merged alias map'
+)
+def main_update_domain_proxy(domain, proxy_file, proxy_email, merge=False):
     """don't do anything but update the virtual address file with the current in/out email
     addresses. If you need to do anything else, like set dkim or smtp passwords, use
     add-domain"""
@@ -398,7 +415,8 @@ def main_update_domain_proxy(domain, proxy_file, proxy_email):
     if not domain:
         domain = p.autodiscover_domain(proxy_file)
 
-    p.add_domain(domain, proxy_file, proxy_email)
+    # without --merge a merged map is still kept up to date if there is one
+    p.add_domain(domain, proxy_file, proxy_email, merge or None)
     p.restart()
 
 
@@ -407,14 +425,19 @@ def main_update_domain_proxy(domain, proxy_file, proxy_email):
 @arg('--proxy-email', default="", help='The final destination email address')
 @arg('--smtp-username', default="smtp", help='smtp username for sending emails')
 @arg('--smtp-password', default="", help='smtp password for sending emails')
-def main_add_domain(domain, proxy_file, proxy_email, smtp_username, smtp_password):
+@arg(
+    '--merge',
+    action="store_true",
+    help='Compile all the domains\' addresses into one merged alias map'
+)
+def main_add_domain(domain, proxy_file, proxy_email, smtp_username, smtp_password, merge=False):
     """add one virtual domain to postfix"""
     p = Postfix()
 
     if not domain:
         domain = p.autodiscover_domain(proxy_file)
 
-    p.add_domain(domain, proxy_file, proxy_email)
+    p.add_domain(domain, proxy_file, proxy_email, merge or None)
 
     echo.h3("Configuring DKIM for {}", domain)
     dk = DKIM()
@@ -456,7 +479,7 @@ def main_lockdown_postfix(mailserver):
     # make sure we've got a backup before we start messing with stuff, we won't
     # create a backup if it already exists
     main_f = p.main_f
-    main_bak = main_f.backup(suffix=".lockdown.bak", ignore_existing=False)
+    main_bak = p.base_create("lockdown", [main_f])[0]
 
     external_ip = cli.ip()
 
@@ -470,7 +493,7 @@ def main_lockdown_postfix(mailserver):
         ("/^[0-9.]+$/", "550 Your software is not RFC 2821 compliant"),
         ("/^[0-9]+(\.[0-9]+){3}$/", "550 Your software is not RFC 2821 compliant")
     )
-    h.save()
+    changed = h.save()
 
     m = p.main(main_bak.path)
     m.update(
@@ -531,14 +554,15 @@ def main_lockdown_postfix(mailserver):
         # on the same domain, postfix will break it out to two different email messages instead of one.
         ("smtp_extra_recipient_limit", 10),
     )
-    m.save()
+    changed = m.save() or changed
 
     # dbl.spamhaus.org
     # xbl.spamhaus.org
     # b.barracudacentral.org
     # http://serverfault.com/a/514830/190381
 
-    p.restart()
+    if changed:
+        p.restart()
 
 
 def main_lockdown_spam():
@@ -546,7 +570,14 @@ def main_lockdown_spam():
     s = Spam()
     s.install()
 
-    c = s.config()
+    p = Postfix()
+    configs = load({
+        "config": (SpamAssassin, s.config_f.path),
+        "local": (Local, s.local_f.path),
+        "master": (Master, p.master_f.path),
+    })
+
+    c = configs["config"]
     c.update(
         ("ENABLED", 1),
         ("OPTIONS", '"--create-prefs --max-children 5 --username {} --helper-home-dir {} -s /var/log/spamd.log"'.format(
@@ -559,7 +590,7 @@ def main_lockdown_spam():
 
     required_score = 4.0
 
-    c = s.local()
+    c = configs["local"]
     c.update(
         ("rewrite_header", "Subject *****SPAM***** _SCORE_ *"),
         ("report_safe", 0),
@@ -589,17 +620,15 @@ def main_lockdown_spam():
     c.save()
 
     # make backup of master.cf if it doesn't already exist
-    p = Postfix()
 #     master_bak = p.base_create("spam", [p.master_f])[0]
 #     m = p.master(master_bak)
-    m = p.master()
+    m = configs["master"]
 
     # add the config to master.cf to enable smtp sending
-    for smtp in m["smtp"]:
-        if smtp.cmd == "smtpd":
-            smtp.update(
-                ("content_filter", "spamassassin")
-            )
+    for smtp in m.find_command("smtpd", "smtp"):
+        smtp.update(
+            ("content_filter", "spamassassin")
+        )
 
     section = m.create_section("spamassassin unix - n n - - pipe")
     section.update(
@@ -698,7 +727,8 @@ def main_install(**kwargs):
         main_add_domains(
             proxy_domains=kwargs["proxy_domains"],
             smtp_username=kwargs["smtp_username"],
-            smtp_password=kwargs["smtp_password"]
+            smtp_password=kwargs["smtp_password"],
+            merge=kwargs["merge"]
         )
 
     else:
@@ -707,7 +737,8 @@ def main_install(**kwargs):
             proxy_file=kwargs["proxy_file"],
             proxy_email=kwargs["proxy_email"],
             smtp_username=kwargs["smtp_username"],
-            smtp_password=kwargs["smtp_password"]
+            smtp_password=kwargs["smtp_password"],
+            merge=kwargs["merge"]
         )
 
 
@@ -0,0 +1,165 @@
+"""
+Caches parsed configuration files so the same unchanged file doesn't have to be
+parsed over and over again, see Config.cache
+"""
+import os
+import gc
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+import cPickle as pickle
+from cStringIO import StringIO
+
+
+class ConfigCache(object):
+    """Cache of parsed configs keyed by the path, size, modified time, and content
+    hash of the file they were parsed from
+
+    There are two layers, an in-process layer that keeps the last size parsed
+    files in memory, and an optional on-disk layer (if directory is set) so
+    separate runs of the command line can share parsed files. Both layers keep the
+    pickled lines of the config instead of the objects themselves, so every load
+    gets its own fresh objects that it is free to modify
+    """
+    blocksize = 204800
+
+    def __init__(self, size=32, directory="", disk_size=128):
+        """
+        :param size: int, how many parsed files to keep in memory
+        :param directory: string, where the on-disk layer keeps its files, if empty
+            there is no on-disk layer
+        :param disk_size: int, how many parsed files to keep on disk
+        """
+        self.size = size
+        self.directory = directory
+        self.disk_size = disk_size
+        self.entries = OrderedDict()
+        # configs can be parsed from more than one thread, see concur.loader
+        self.lock = threading.Lock()
+
+    def stamp(self, path):
+        """return the (size, mtime, content hash) of path, or None if path doesn't
+        exist"""
+        try:
+            st = os.stat(path)
+            h = hashlib.md5()
+            with open(path, "rb") as fp:
+                for block in iter(lambda: fp.read(self.blocksize), ""):
+                    h.update(block)
+
+        except (OSError, IOError):
+            return None
+
+        return (st.st_size, st.st_mtime, h.hexdigest())
+
+    def disk_path(self, config_class, path):
+        name = hashlib.md5(":".join([
+            config_class.__module__,
+            config_class.__name__,
+            os.path.abspath(path),
+        ])).hexdigest()
+        return os.path.join(self.directory, "{}.pickle".format(name))
+
+    def load(self, config, stamp):
+        """fill in config's lines and indexes from the cache
+
+        :param config: Config, the config that wants to be parsed
+        :param stamp: tuple, what stamp() returned for config.prototype_path
+        :returns: boolean, True if config was loaded from the cache
+        """
+        if not stamp: return False
+
+        key = (type(config), config.prototype_path)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+        if entry is None and self.directory:
+            try:
+                with open(self.disk_path(type(config), config.prototype_path), "rb") as fp:
+                    entry = pickle.load(fp)
+            except (IOError, EOFError, pickle.UnpicklingError):
+                entry = None
+
+        if entry is None or entry[0] != stamp:
+            return False
+
+        with self.lock:
+            self.entries[key] = entry
+            self.evict()
+
+        unpickler = pickle.Unpickler(StringIO(entry[1]))
+        unpickler.persistent_load = lambda pid: config
+        # unpickling creates a lot of objects that can't be garbage, so don't let
+        # the collector keep scanning them while they're being built
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            config.lines, config.options, config.sections = unpickler.load()
+
+        finally:
+            if enabled:
+                gc.enable()
+
+        return True
+
+    def save(self, config, stamp):
+        """put config's parsed lines into the cache
+
+        :returns: boolean, True if config was cached
+        """
+        if not stamp: return False
+
+        buf = StringIO()
+        pickler = pickle.Pickler(buf, 2)
+        # the lines all point back to config, that gets reconnected on load
+        pickler.inst_persistent_id = lambda obj: "config" if obj is config else None
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            pickler.dump((config.lines, config.options, config.sections))
+
+        except (pickle.PicklingError, TypeError):
+            # classes defined inside functions can't be pickled
+            return False
+
+        finally:
+            if enabled:
+                gc.enable()
+
+        entry = (stamp, buf.getvalue())
+        with self.lock:
+            self.entries[(type(config), config.prototype_path)] = entry
+            self.evict()
+
+        if self.directory:
+            self.save_disk(self.disk_path(type(config), config.prototype_path), entry)
+
+        return True
+
+    def save_disk(self, path, entry):
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(fd, "wb") as fp:
+                pickle.dump(entry, fp, 2)
+            os.rename(tmp_path, path)
+
+            paths = [os.path.join(self.directory, n) for n in os.listdir(self.directory)]
+            if len(paths) > self.disk_size:
+                paths.sort(key=os.path.getmtime)
+                for p in paths[:len(paths) - self.disk_size]:
+                    os.unlink(p)
+
+        except (OSError, IOError):
+            # the on-disk layer is only an optimization
+            pass
+
+    def evict(self):
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
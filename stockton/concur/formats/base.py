@@ -5,13 +5,639 @@ usually, you would actually use the classes in generics.py as the start for your
 configuration parser, the classes in this module are the support classes for the
 generics
 """
+import os
 import re
-from collections import defaultdict
+import stat
+import mmap
+import hashlib
+import tempfile
+from collections import defaultdict, deque
+from bisect import bisect_left, bisect_right
+from operator import attrgetter
+from contextlib import contextmanager
 import itertools
+import difflib
+
+
+
+class NameMatcher(object):
+    """matches a line against all of a config's option_name_regexes at once
+
+    the literal text each pattern starts with (eg, "score" for ^score\s+\S+) goes
+    into a trie, so walking the start of a line once finds the only patterns that
+    could match it, patterns that don't start with any literal text are always
+    tried. Like looping through all the patterns, the last declared pattern that
+    matches wins
+    """
+    metachars = set(".^$*+?{}[]\\|()")
+
+    def __init__(self, patterns):
+        self.trie = {}
+        self.fallback = []
+        for i, pattern in enumerate(patterns):
+            prefix = self.prefix(pattern)
+            regex = (i, re.compile(pattern))
+            if prefix:
+                node = self.trie
+                for ch in prefix:
+                    node = node.setdefault(ch, {})
+                node.setdefault(None, []).append(regex)
+
+            else:
+                self.fallback.append(regex)
+
+    def __len__(self):
+        return len(self.fallback) + self.count(self.trie)
+
+    def count(self, node):
+        return sum(len(v) if k is None else self.count(v) for k, v in node.items())
+
+    def prefix(self, pattern):
+        """return the literal text pattern has to start with"""
+        if "|" in pattern: return ""
+
+        prefix = []
+        for ch in pattern.lstrip("^"):
+            if ch in self.metachars:
+                # a quantifier means the char before it is optional
+                if ch in "*?{" and prefix:
+                    prefix.pop()
+                break
+            prefix.append(ch)
+
+        return "".join(prefix)
+
+    def match(self, line):
+        """return the match of the last pattern that matches the start of line, or
+        None"""
+        regexes = self.fallback
+        node = self.trie
+        for ch in line:
+            node = node.get(ch)
+            if node is None: break
+            if None in node:
+                regexes = regexes + node[None]
+
+        for _, regex in sorted(regexes, reverse=True):
+            m = regex.match(line)
+            if m: return m
+
+
+class ConfigGrammar(object):
+    """the compiled regexes a Config class uses to tokenize its lines
+
+    every Config class gets its own instance of this when the class is created (see
+    ConfigMeta) so the regexes built from commenters, option_divider, and
+    option_name_regexes are only compiled once instead of on every parsed line
+    """
+    def __init__(self, config_class):
+        commenters = config_class.commenters
+        divider = config_class.option_divider
+        self.commenters = commenters
+        self.divider = divider
+
+        # name = val
+        self.option_regex = re.compile("^[^{}]\S+".format(commenters))
+        # # name = val
+        self.commented_option_regex = re.compile("^[{}]\s*\S+\s*{}".format(commenters, divider))
+        self.commenter_regex = re.compile("^[{}]\s*".format(commenters))
+        self.divider_regex = re.compile("\s*{}\s*".format(divider))
+        self.comment_regex = re.compile("\s[{}]\s*".format(commenters))
+        self.option_name_regexes = NameMatcher(config_class.option_name_regexes)
+
+    def split(self, line):
+        """split line into name and val"""
+        name = ""
+        val = ""
+        m = self.option_name_regexes.match(line)
+        if m:
+            name = m.group(0)
+            _, val = self.divider_regex.split(line[m.end(0):], 1)
+
+        if not name:
+            name, val = self.divider_regex.split(line, 1)
+
+        return name, val
+
+    def split_name(self, line):
+        """like split() but only finds the name, the val is left in the line
+
+        :returns: tuple, (name, offset) where offset is where the val starts in line
+        """
+        name = ""
+        offset = 0
+        m = self.option_name_regexes.match(line)
+        if m:
+            name = m.group(0)
+            offset = m.end(0)
+
+        m = self.divider_regex.search(line, offset)
+        if not m:
+            raise ValueError("no option divider found in line {}".format(line))
+
+        if not name:
+            name = line[:m.start()]
+
+        return intern_name(name), m.end()
+
+    def tokenize_name(self, line):
+        """the cheap version of tokenize() that only returns the name and where
+        the val starts in line, see tokenize_val()
+
+        :returns: tuple, (name, offset), name will be empty if line isn't an option
+        """
+        name = ""
+        offset = 0
+        if self.option_regex.match(line): # name = val
+            name, offset = self.split_name(line)
+
+        elif self.commented_option_regex.match(line): # # name = val
+            start = self.commenter_regex.match(line).end()
+            name, offset = self.split_name(line[start:])
+            offset += start
+
+        return name, offset
+
+    def tokenize_val(self, line, offset):
+        """finish what tokenize_name() started
+
+        :returns: tuple, (val, comment)
+        """
+        bits = self.comment_regex.split(line[offset:], 1)
+        return bits[0], bits[1] if len(bits) > 1 else ""
+
+    def is_option(self, line):
+        """cheap check to see if tokenize() would find an option name in line"""
+        return bool(self.option_regex.match(line) or self.commented_option_regex.match(line))
+
+    def tokenize(self, line):
+        """split an option line into its name, val, and comment
+
+        :param line: string, the option line
+        :returns: tuple, (name, val, comment), name will be empty if line isn't
+            an option
+        """
+        name = ""
+        val = ""
+        comment = ""
+
+        if self.option_regex.match(line): # name = val
+            name, val = self.split(line)
+
+        elif self.commented_option_regex.match(line): # # name = val
+            name, val = self.split(self.commenter_regex.sub("", line, 1))
+
+        bits = self.comment_regex.split(val, 1)
+        val = bits[0]
+        if len(bits) > 1:
+            comment = bits[1]
+
+        return intern_name(name), val, comment
+
+
+def intern_name(name):
+    """option names repeat a lot (think score or -o lines) so every parsed line
+    shares the one copy of each name"""
+    return intern(name) if type(name) is str else name
+
+
+class ConfigMeta(type):
+    """compiles the grammar of every Config class when the class is created"""
+    def __init__(cls, name, bases, properties):
+        super(ConfigMeta, cls).__init__(name, bases, properties)
+        cls.grammar = cls.grammar_class(cls)
+
+
+class ConfigLines(object):
+    """the ordered lines of a config or section
+
+    this acts like a list of lines but every line also gets an ordering key, the
+    keys are handed out with big gaps between them so a line can be inserted
+    between two others without touching anything else, and the current position
+    of any line is a binary search of the keys instead of a scan of the lines.
+    When a gap runs out only the neighbourhood around the insert gets its keys
+    spread back out
+    """
+    gap = 1 << 32
+
+    def __init__(self, lines=None):
+        self.lines = []
+        self.keys = []
+        self.orders = {} # id(line) -> key
+        for line in lines or []:
+            self.append(line)
+
+    def __getstate__(self):
+        return (self.lines, self.keys)
+
+    def __setstate__(self, state):
+        self.lines, self.keys = state
+        self.orders = dict((id(line), key) for line, key in zip(self.lines, self.keys))
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __iter__(self):
+        return iter(self.lines)
+
+    def __getitem__(self, i):
+        return self.lines[i]
+
+    def index(self, line):
+        """return the current position of line"""
+        return bisect_left(self.keys, self.orders[id(line)])
+
+    def append(self, line):
+        key = self.keys[-1] + self.gap if self.keys else self.gap
+        self.lines.append(line)
+        self.keys.append(key)
+        self.orders[id(line)] = key
+
+    def insert(self, i, line):
+        if i >= len(self.lines):
+            return self.append(line)
+
+        i = max(i, 0)
+        if self.keys[i] - (self.keys[i - 1] if i > 0 else 0) < 2:
+            self.respace(i)
+
+        key = ((self.keys[i - 1] if i > 0 else 0) + self.keys[i]) // 2
+        self.lines.insert(i, line)
+        self.keys.insert(i, key)
+        self.orders[id(line)] = key
+
+    def remove(self, line):
+        i = self.index(line)
+        del self.lines[i]
+        del self.keys[i]
+        del self.orders[id(line)]
+
+    def replace(self, line, new_line):
+        """put new_line where line is, new_line gets line's key"""
+        i = self.index(line)
+        self.lines[i] = new_line
+        self.orders[id(new_line)] = self.orders.pop(id(line))
+
+    def copy(self):
+        lines = ConfigLines()
+        lines.lines = list(self.lines)
+        lines.keys = list(self.keys)
+        lines.orders = dict(self.orders)
+        return lines
+
+    def respace(self, i):
+        """spread out the keys around position i, the window doubles until it
+        is sparse enough to be evenly respaced (or it reaches the end, where there
+        is always room)"""
+        count = len(self.keys)
+        size = 1
+        while True:
+            start = max(i - size, 0)
+            stop = min(i + size, count)
+            floor = self.keys[start - 1] if start > 0 else 0
+            if stop >= count:
+                step = self.gap
+
+            else:
+                step = (self.keys[stop] - floor) // (stop - start + 1)
+
+            if step >= 2:
+                for j in range(start, stop):
+                    floor += step
+                    self.keys[j] = floor
+                    self.orders[id(self.lines[j])] = floor
+                break
+
+            size *= 2
+
+
+def file_matches(path, body):
+    """return True if the file at path already contains exactly body, the sizes
+    are checked first, then the hashes, and only then the actual bytes"""
+    try:
+        if os.path.getsize(path) != len(body):
+            return False
+
+        h = hashlib.md5()
+        with open(path, "rb") as fp:
+            for block in iter(lambda: fp.read(204800), ""):
+                h.update(block)
+        if h.digest() != hashlib.md5(body).digest():
+            return False
+
+        with open(path, "rb") as fp:
+            return fp.read() == body
+
+    except (OSError, IOError):
+        return False
+
+
+def write_atomic(path, body):
+    """write body to a temp file in the same directory as path and then rename it
+    over path, so path is never half written, the temp file gets path's existing
+    permissions and owner
+
+    :param path: string, the destination path
+    :param body: string|callable, the contents, if callable it will be passed the
+        open temp file so it can write to it
+    """
+    path = os.path.realpath(path)
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path),
+        prefix=".{}.".format(os.path.basename(path))
+    )
+    try:
+        with os.fdopen(fd, "wb") as fp:
+            if callable(body):
+                body(fp)
+            else:
+                fp.write(body)
+            fp.flush()
+            os.fsync(fp.fileno())
+
+        try:
+            st = os.stat(path)
+            os.chmod(tmp_path, stat.S_IMODE(st.st_mode))
+            try:
+                os.chown(tmp_path, st.st_uid, st.st_gid)
+            except OSError:
+                pass
+
+        except OSError:
+            # new file, so give it the permissions open() would have
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp_path, 0o666 & ~umask)
+
+        os.rename(tmp_path, path)
+
+    except:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+class Opcodes(difflib.SequenceMatcher):
+    """lets difflib group opcodes that were worked out some other way, see
+    Config.diff()"""
+    def __init__(self, opcodes):
+        self.opcodes = opcodes
+
+    def get_opcodes(self):
+        return list(self.opcodes)
+
+
+def unified_range(start, stop):
+    """format a hunk range the way diff -u does"""
+    length = stop - start
+    if length == 1:
+        return "{}".format(start + 1)
+    if not length:
+        return "{},0".format(start)
+    return "{},{}".format(start + 1, length)
+
+
+def unified_diff(old, new, opcodes, fromfile="", tofile="", n=3):
+    """like difflib.unified_diff() but for opcodes that are already known
+
+    :param old: list, the old lines
+    :param new: list, the new lines
+    :param opcodes: list, difflib style (tag, i1, i2, j1, j2) tuples
+    :returns: string, the diff, empty if there are no changes
+    """
+    lines = []
+    for group in Opcodes(opcodes).get_grouped_opcodes(n):
+        if not lines:
+            lines.append("--- {}".format(fromfile))
+            lines.append("+++ {}".format(tofile))
+
+        first, last = group[0], group[-1]
+        lines.append("@@ -{} +{} @@".format(
+            unified_range(first[1], last[2]),
+            unified_range(first[3], last[4])
+        ))
+        for tag, i1, i2, j1, j2 in group:
+            if tag == "equal":
+                lines.extend(" " + l for l in old[i1:i2])
+                continue
+
+            if tag in ("replace", "delete"):
+                lines.extend("-" + l for l in old[i1:i2])
+
+            if tag in ("replace", "insert"):
+                lines.extend("+" + l for l in new[j1:j2])
+
+    return "\n".join(lines) + "\n" if lines else ""
+
+
+def patch_lines(lines, patch):
+    """apply a unified diff to lines, every hunk has to match exactly
+
+    :param lines: list, the lines to patch
+    :param patch: string, a unified diff like unified_diff() creates
+    :returns: list, the patched lines
+    """
+    hunk_regex = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+    ret = []
+    pos = 0
+    pls = iter(patch.splitlines())
+    for pl in pls:
+        m = hunk_regex.match(pl)
+        if not m: continue
+
+        old_start, old_count, _, new_count = m.groups()
+        old_count = 1 if old_count is None else int(old_count)
+        new_count = 1 if new_count is None else int(new_count)
+        start = int(old_start) - 1 if old_count else int(old_start)
+        if start < pos or start > len(lines):
+            raise ValueError("hunk {} is out of order or past the end".format(pl))
+
+        ret.extend(lines[pos:start])
+        pos = start
+        while old_count or new_count:
+            pl = next(pls, None)
+            if pl is None:
+                raise ValueError("patch ended in the middle of a hunk")
+
+            tag, l = pl[:1], pl[1:]
+            if tag == "\\": continue # \ No newline at end of file
+
+            if tag in (" ", "-"):
+                if pos >= len(lines) or lines[pos] != l:
+                    raise ValueError("line {} does not match the patch: {}".format(pos + 1, l))
+                pos += 1
+                old_count -= 1
+
+            if tag in (" ", "+"):
+                ret.append(l)
+                new_count -= 1
+
+    ret.extend(lines[pos:])
+    return ret
+
+
+slots_cache = {}
+
+
+def slot_names(cls):
+    """return all the __slots__ names of cls and its parents"""
+    names = slots_cache.get(cls)
+    if names is None:
+        names = []
+        for c in cls.__mro__:
+            for name in c.__dict__.get("__slots__", ()):
+                if name not in names:
+                    names.append(name)
+        slots_cache[cls] = names
+    return names
+
+
+def tracked_property(name):
+    """create a property for name that marks its instance as modified when it is
+    set, the value itself lives in the "_name" slot so parsers can fill it in
+    directly without flipping modified
+
+    :param name: string, the public name of the attribute
+    :returns: property
+    """
+    attr = "_{}".format(name)
+    def fset(self, v):
+        self.unlazy()
+        setattr(self, attr, v)
+        self.modified = True
+    return property(attrgetter(attr), fset)
+
+
+def lazy_property(name):
+    """like tracked_property but if the instance hasn't been modified and the
+    "_name" slot is None (lazy configs leave it empty) then the value is parsed
+    out of the instance's line with materialize(name) every time it is needed,
+    only setting it stores a copy"""
+    attr = "_{}".format(name)
+    def fget(self):
+        v = getattr(self, attr)
+        if v is None and not self._modified:
+            v = self.materialize(name)
+        return v
+
+    def fset(self, v):
+        self.unlazy()
+        setattr(self, attr, v)
+        self.modified = True
+    return property(fget, fset)
+
+
+class ConfigBatch(object):
+    """collects the inserts and deletes made to a config or section inside of a
+    ConfigBase.batch() block so they can all be merged into the lines in one pass
+    when the block finishes, sets on existing options happen right away but are
+    remembered so they can be undone if the block fails
+
+    changes will contain the changeset, a list of (action, name, val) tuples where
+    action is one of "set", "insert", or "delete"
+    """
+    def __init__(self, container):
+        self.container = container
+        self.inserts = [] # (line_number, order, option)
+        self.deletes = {} # id(option) -> option
+        self.options = defaultdict(list) # name -> inserted options
+        self.undo = [] # (option, val, modified)
+        self.changes = []
+
+    # one merge pass over all the lines is only worth it once there are more than
+    # len(lines) / merge_ratio changes
+    merge_ratio = 16
+
+    def insert(self, line_number, option):
+        self.inserts.append((line_number, len(self.inserts), option))
+        # plain lines (comments, raw strings passed to update()) have no name
+        name = getattr(option, "name", None)
+        if name is not None:
+            self.options[name].append(option)
+
+    def delete(self, option):
+        inserts = [t for t in self.inserts if t[2] is not option]
+        if len(inserts) < len(self.inserts):
+            # an option inserted earlier in the batch is just dropped
+            self.inserts = inserts
+            name = getattr(option, "name", None)
+            if name is not None:
+                self.options[name].remove(option)
+            return
+
+        self.deletes[id(option)] = option
+
+    def set(self, option, v):
+        """called right before option is updated to v"""
+        self.undo.append((option, option.val, option.modified))
+
+    def find_options(self, k):
+        return [o for o in self.options.get(k, []) if id(o) not in self.deletes]
+
+    def commit(self):
+        """merge the pending inserts and deletes into the container"""
+        container = self.container
+        inserts = sorted(self.inserts, key=lambda t: (t[0], t[1]))
+        deletes = self.deletes
+
+        for option, _, _ in self.undo:
+            self.changes.append(("set", option.name, option.val))
+
+        count = len(container.lines)
+        if not deletes and (not inserts or inserts[0][0] >= count):
+            # everything goes on the end so there is nothing to merge
+            for _, _, option in inserts:
+                container.append(option)
+
+        elif (len(inserts) + len(deletes)) * self.merge_ratio < count:
+            # a handful of changes in a big config, the lines can take these in place
+            # cheaper than rebuilding everything
+            anchors = [container.lines[t[0]] if t[0] < count else None for t in inserts]
+            for anchor, (_, _, option) in zip(anchors, inserts):
+                if anchor is None:
+                    container.append(option)
+                else:
+                    container.insert(container.lines.index(anchor), option)
+
+            for option in deletes.values():
+                container.remove(option)
+
+        else:
+            lines = []
+            i = 0
+            for line_number, line in enumerate(container.lines):
+                while i < len(inserts) and inserts[i][0] <= line_number:
+                    lines.append(inserts[i][2])
+                    i += 1
+
+                if id(line) not in deletes:
+                    lines.append(line)
+
+            lines.extend(option for _, _, option in inserts[i:])
+            lines = [line for line in lines if id(line) not in deletes]
+            container.reindex(lines)
+
+        for _, _, option in inserts:
+            name = getattr(option, "name", None)
+            if name is not None and id(option) not in deletes:
+                self.changes.append(("insert", name, getattr(option, "val", None)))
+
+        for option in deletes.values():
+            name = getattr(option, "name", None)
+            if name is not None:
+                self.changes.append(("delete", name, None))
+
+    def rollback(self):
+        """undo any sets, pending inserts and deletes are just dropped"""
+        for option, val, modified in reversed(self.undo):
+            option._val = val
+            option.modified = modified
 
 
 class ConfigBase(object):
     """the base common class for most of the other more useful classes"""
+    __slots__ = ()
+
     @property
     def factory(self):
         try:
@@ -34,11 +660,56 @@ class ConfigBase(object):
         # true line numbers in the config file, they are line numbers in relation
         # to the content area you are in, so if the config file has 2 sections, then
         # there will only be 2 "lines" in that config file, one for each section
-        self.lines = []
+        self.lines = ConfigLines()
+
+        # the ConfigBatch when inside a batch() block
+        self.pending = None
+        self.changed()
 
         self.name = ""
         self.val = ""
 
+    def reindex(self, lines):
+        """replace lines and rebuild the sections and options indexes in one pass"""
+        self.lines = ConfigLines()
+        self.sections = defaultdict(list)
+        self.options = defaultdict(list)
+        self.changed()
+        for line in lines:
+            self.append(line)
+
+    @contextmanager
+    def batch(self):
+        """collect all the changes made inside the with block and merge them in one
+        pass when the block is done, if the block raises an error then all the
+        changes are undone
+
+        :example:
+            with config.batch() as b:
+                config["foo"] = "bar"
+                config.update_before("che", ("baz", 1))
+            print(b.changes)
+
+        :returns: ConfigBatch, nested batch() calls get the outer batch
+        """
+        if self.pending:
+            yield self.pending
+
+        else:
+            pending = ConfigBatch(self)
+            self.pending = pending
+            try:
+                yield pending
+
+            except:
+                self.pending = None
+                pending.rollback()
+                raise
+
+            else:
+                self.pending = None
+                pending.commit()
+
     def parse(self, fp):
         self.line = fp.line
         self._parse(fp)
@@ -66,99 +737,153 @@ class ConfigBase(object):
         return True
 
     def update(self, *args, **kwargs):
-        for body in itertools.chain(args, kwargs.items()):
-            if isinstance(body, basestring):
-                line = self.factory.create_line()
-                line.line = body
-                self.insert(len(self.lines), line)
-            else:
-                k, v = body
-                self[k] = v
+        """set all the (key, val) args and kwargs, any string args are added as
+        lines, this all happens in one batch()
+
+        :returns: list, the changeset, see ConfigBatch
+        """
+        with self.batch() as b:
+            for body in itertools.chain(args, kwargs.items()):
+                if isinstance(body, basestring):
+                    line = self.factory.create_line()
+                    line.line = body
+                    self.insert(len(self.lines), line)
+                else:
+                    k, v = body
+                    self[k] = v
+        return b.changes
 
     def update_before(self, k, *args, **kwargs):
         """same as update but will insert all the args and kwargs before the option
         at k"""
-        line_numbers = self.find_lines(k)
-        if line_numbers:
-            line_number = line_numbers[0] # the min line number you need to insert before
-            for k, v in itertools.chain(args, kwargs.items()):
-                if k in self:
-                    self[k] = v
+        with self.batch() as b:
+            line_numbers = self.find_lines(k)
+            if line_numbers:
+                line_number = line_numbers[0] # the min line number you need to insert before
+                for k, v in itertools.chain(args, kwargs.items()):
+                    if k in self:
+                        self[k] = v
+
+                    else:
+                        option = self.create_option_for_key(k)
+                        option.val = v
+                        self.insert(line_number, option)
 
-                else:
-                    option = self.create_option_for_key(k)
-                    option.val = v
-                    self.insert(line_number, option)
+            else:
+                self.update(*args, **kwargs)
+        return b.changes
 
-        else:
-            self.update(*args, **kwargs)
+    def index_option(self, option):
+        """add option to the sections or options index, this doesn't touch lines"""
+        factory = self.factory
+        if isinstance(option, factory.section_class):
+            self.sections[option.name].append(option)
+
+        elif isinstance(option, factory.option_class):
+            self.options[option.name].append(option)
+
+    def append(self, option):
+        """add option to the end, this is the fast path used while parsing"""
+        self.lines.append(option)
+        self.index_option(option)
+        option.parent = self
+        self.changed(option)
 
     def insert(self, line_number, option):
         """insert option before the given line_number, this is similar to the python
         built-in list.insert method, you need to use this function to keep all the
         internal data structurs in alignment"""
-        if line_number < len(self.lines):
-            # go through and move everything down to compensate for the
-            # insert in the line_number list and line everything back up again
-            for k in self.options.keys():
-                k_line_numbers = self.options[k]
-                for i in range(len(k_line_numbers)):
-                    if k_line_numbers[i] > line_number:
-                        k_line_numbers[i] += 1
-
-            for k in self.sections.keys():
-                k_line_numbers = self.sections[k]
-                for i in range(len(k_line_numbers)):
-                    if k_line_numbers[i] > line_number:
-                        k_line_numbers[i] += 1
+        if self.pending:
+            self.pending.insert(line_number, option)
+            return
 
         self.lines.insert(line_number, option)
-        if isinstance(option, self.factory.option_class):
-            self.options[option.name].append(line_number)
-
-        else:
-            self.sections[option.name].append(line_number)
-
-    def __setattr__(self, k, v):
-        # http://stackoverflow.com/questions/17576009/python-class-property-use-setter-but-evade-getter
-        if k == "modified":
-            self.__dict__["modified"] = v
-
-        else:
-            self.modified = True
-            super(ConfigBase, self).__setattr__(k, v)
+        self.index_option(option)
+        option.parent = self
+        self.changed(option)
+
+    def remove(self, option):
+        """remove option from lines and the sections/options index"""
+        if self.pending:
+            self.pending.delete(option)
+            return
+
+        self.lines.remove(option)
+        # listeners are told before the line is detached so they can still see
+        # where it was (see Config.add_listener())
+        self.changed(option)
+        # a forked config can remove a line it still shares with another config
+        if option.parent is self:
+            option.parent = None
+        name = getattr(option, "name", None)
+        if name is None: return
+
+        for index in (self.sections, self.options):
+            if name in index:
+                options = index[name]
+                if option in options:
+                    options.remove(option)
+                    if not options:
+                        del index[name]
 
     def __missing__(self, k):
+        if self.pending:
+            options = self.pending.find_options(k)
+            if options:
+                return options[0] if len(options) == 1 else options
+
         option = self.create_option_for_key(k)
         self.insert(len(self.lines), option)
         return option
 
     def __contains__(self, k):
+        if self.pending and self.pending.find_options(k):
+            return True
         return k in self.sections or k in self.options
 
-    def find_lines(self, k):
-        """return how many lines the key is found in the config file"""
-        line_numbers = []
+    def __delitem__(self, k):
+        options = self.find_options(k)
+        if self.pending:
+            options = options + self.pending.find_options(k)
+        if not options:
+            raise KeyError(k)
+
+        for option in options:
+            self.remove(option)
+
+    def find_options(self, k):
+        """return all the sections or options with name k, in line order"""
+        options = []
 
         if k in self.sections:
-            line_numbers = self.sections[k]
+            options = self.sections[k]
 
         elif k in self.options:
-            line_numbers = self.options[k]
+            options = self.options[k]
+
+        if self.pending and self.pending.deletes:
+            options = [o for o in options if id(o) not in self.pending.deletes]
+
+        if len(options) > 1:
+            options = sorted(options, key=self.lines.index)
 
-        return line_numbers
+        return options
+
+    def find_lines(self, k):
+        """return the line numbers the key is found at in the config file"""
+        return [self.lines.index(option) for option in self.find_options(k)]
 
     def __getitem__(self, k):
-        line_numbers = self.find_lines(k)
+        options = self.find_options(k)
 
-        # after we have the line count, we pull out that many lines, it's a string
-        # if it is a one line value, or an array of lines if it encompassed more than
-        # one line, if we didn't find the value at all, then create it
-        if len(line_numbers) == 1:
-            v = self.lines[line_numbers[0]]
+        # after we have the lines, it's a single option if it is a one line value,
+        # or an array of options if it encompassed more than one line, if we didn't
+        # find the value at all, then create it
+        if len(options) == 1:
+            v = options[0]
 
-        elif len(line_numbers) > 1:
-            v = [self.lines[ln] for ln in line_numbers]
+        elif len(options) > 1:
+            v = options
 
         else:
             v = self.__missing__(k)
@@ -169,7 +894,11 @@ class ConfigBase(object):
     def __setitem__(self, k, v):
         if isinstance(v, self.factory.section_class):
             if k in self.sections:
-                self.sections[k] = v
+                # replace the first section with the same name
+                section = self.find_options(k)[0]
+                self.insert(self.lines.index(section), v)
+                self.remove(section)
+
             else:
                 self.insert(len(self.lines), v)
 
@@ -177,34 +906,101 @@ class ConfigBase(object):
             if k in self.sections:
                 raise ValueError("you cannot set a section with a string, use a section class")
 
-            line_numbers = []
+            options = []
 
             if k in self.options:
-                line_numbers = self.options[k]
-
-            if len(line_numbers) > 0:
-                updated = False
-                for line_number in line_numbers:
-                    option = self.lines[line_number]
+                options = self.find_options(k)
+
+            updated = False
+            for option in options:
+                if self.pending:
+                    self.pending.set(option, v)
+                updated |= self.update_option(option, v)
+                #option.val = v
+
+            # options inserted earlier in the same batch get a say too
+            if self.pending:
+                for option in self.pending.find_options(k):
                     updated |= self.update_option(option, v)
-                    #option.val = v
-
-                # if update_option never returned True, then assume option is a
-                # new option and add it
-                if not updated:
-                    option = self.__missing__(k)
-                    option.val = v
 
-
-            else:
-                option = self.__missing__(k)
+            # if update_option never returned True, then assume option is a
+            # new option and add it
+            if not updated:
+                option = self.create_option_for_key(k)
+                self.insert(len(self.lines), option)
                 option.val = v
 
 
 class ConfigLine(ConfigBase):
     """This can be the base class for the different sections and options, or it
     can be a representation of a comment or some other line we don't usually do
-    anything with"""
+    anything with
+
+    lines are slotted and don't carry any of the sections/options/lines indexes,
+    only ConfigSection does, because a config file can have a lot of them
+    """
+    __slots__ = ("config", "parent", "line", "span", "_modified")
+
+    def __init__(self, config):
+        self.config = config
+        self.parent = None
+        self.line = ""
+        # (start, stop) bytes of this line in the source, see MmapConfigFile
+        self.span = None
+        self.modified = True
+
+    @property
+    def modified(self):
+        return self._modified
+
+    @modified.setter
+    def modified(self, v):
+        if v:
+            self.unlazy()
+        self._modified = v
+        self.changed()
+
+    def unlazy(self):
+        """called right before the line is marked modified, see ConfigOption"""
+        pass
+
+    def changed(self, line=None):
+        """called whenever this line is modified, this lets the sections (and the
+        config) this line belongs to know their cached text is out of date
+
+        :param line: ConfigLine, the line that was modified, added, or removed,
+            None means this line itself
+        """
+        self.span = None
+        parent = self.parent
+        if parent is not None:
+            parent.changed(line or self)
+
+    def copy(self, config, parent):
+        """return a copy of this line that belongs to config, see Config.fork()"""
+        cls = type(self)
+        line = cls.__new__(cls)
+        for name in slot_names(cls):
+            if hasattr(self, name):
+                setattr(line, name, getattr(self, name))
+        line.config = config
+        line.parent = parent
+        return line
+
+    def original(self):
+        """return the text this line was parsed from"""
+        return self.line
+
+    def touched(self):
+        """return True if str() could be different than original()"""
+        return self.modified
+
+    @classmethod
+    def matches(cls, config, line):
+        """return True if line should be parsed by this class, this is checked
+        before an instance is created so it should be cheap, see Config.classify()"""
+        return True
+
     def __str__(self):
         return self.line
 
@@ -214,51 +1010,76 @@ class ConfigLine(ConfigBase):
 
 class ConfigOption(ConfigLine):
     """This represents any key -> value pair in the configuration file"""
+    __slots__ = ("_name", "_val", "_comment", "_offset")
+
+    name = tracked_property("name")
+
+    val = lazy_property("val")
+
+    comment = lazy_property("comment")
+
+    def __init__(self, config):
+        super(ConfigOption, self).__init__(config)
+        self._name = ""
+        self._val = ""
+        self._comment = ""
+        # where the val starts in line, see materialize()
+        self._offset = None
+
+    @classmethod
+    def matches(cls, config, line):
+        return config.grammar.is_option(line)
+
     def is_valid(self):
         return bool(self.name)
 
     def _split(self, line):
-        divider = self.config.option_divider
-        name = ""
-        val = ""
-        if self.config.option_name_regexes:
-            for regex in self.config.option_name_regexes:
-                m = re.match(regex, line)
-                if m:
-                    name = m.group(0)
-                    _, val = re.split("\s*{}\s*".format(divider), line[m.end(0):], 1)
-
-        if not name:
-            name, val = re.split("\s*{}\s*".format(divider), line, 1)
-
-        return name, val
+        return self.config.grammar.split(line)
 
     def _parse(self, fp):
         line = fp.line
-        name = ""
-        val = ""
-        comment = ""
-        commenters = self.config.commenters
-        divider = self.config.option_divider
-
-        if re.match("^[^{}]\S+".format(commenters), line): # name = val
-            name, val = self._split(line)
-
-        elif re.match("^[{}]\s*\S+\s*{}".format(commenters, divider), line): # # name = val
-            l = re.sub("^[{}]\s*".format(commenters), "", line)
-            name, val = self._split(l)
+        grammar = self.config.grammar
+        if self.config.lazy:
+            # only remember where the val starts in line instead of a copy of it
+            self._name, self._offset = grammar.tokenize_name(line)
+            self._val = None
+            self._comment = None
 
-        bits = re.split("\s[{}]\s*".format(commenters), val, 1)
-        val = bits[0]
-        if len(bits) > 1:
-            comment = bits[1]
+        else:
+            self._name, self._val, self._comment = grammar.tokenize(line)
 
-        self.name = name
-        self.val = val
-        self.comment = comment
         self.line = line
         self.modified = False
 
+    def materialize(self, name):
+        """parse the val or comment (depending on name) out of line, lazy configs
+        do this every time an unmodified val or comment is needed"""
+        line, _, continuation = self.line.partition("\n")
+        grammar = self.config.grammar
+        offset = self._offset
+        if offset is not None:
+            val, comment = grammar.tokenize_val(line, offset)
+        else:
+            _, val, comment = grammar.tokenize(line)
+
+        if name == "comment":
+            return comment
+
+        if continuation:
+            val += "\n" + continuation
+        return val
+
+    def unlazy(self):
+        """once an option is modified it is rendered from its name, val, and
+        comment instead of its line, so the ones that are still only in the line
+        are parsed out and kept"""
+        if getattr(self, "_offset", None) is None or self._modified: return
+        if self._val is None:
+            self._val = self.materialize("val")
+        if self._comment is None:
+            self._comment = self.materialize("comment")
+        self._offset = None
+
     def __str__(self):
         s = ""
         if self.modified:
@@ -267,9 +1088,9 @@ class ConfigOption(ConfigLine):
                 self.config.option_divider,
                 self.val
             )
-            comment = getattr(self, "comment", "")
+            comment = self.comment
             if comment:
-                s += " {} {}".format(self.commenters[0], comment)
+                s += " {} {}".format(self.config.commenters[0], comment)
 
         else:
             s = super(ConfigOption, self).__str__()
@@ -286,68 +1107,269 @@ class ConfigSection(ConfigOption):
     """certain configuration files might be broken up into sections of options, this
     handles representing those sections so when manipulating the config file you can
     add and rename sections, etc."""
+    __slots__ = ("lines", "options", "sections", "pending", "parsed", "_str")
+
+    def __init__(self, config):
+        self._str = None
+        self.parsed = ()
+        super(ConfigSection, self).__init__(config)
+        self.reset()
+
+    def parse(self, fp):
+        super(ConfigSection, self).parse(fp)
+        # the lines as they were in the file, see Config.diff()
+        self.parsed = tuple(self.lines)
+
+    def copy(self, config, parent):
+        """sections are copied with all their lines so the copy can be modified
+        without touching the original"""
+        section = super(ConfigSection, self).copy(config, parent)
+        section.lines = ConfigLines()
+        section.sections = defaultdict(list)
+        section.options = defaultdict(list)
+        section.pending = None
+
+        copies = {}
+        for cl in self.lines:
+            c = cl.copy(config, section)
+            copies[id(cl)] = c
+            section.lines.append(c)
+            section.index_option(c)
+
+        section.parsed = tuple(copies.get(id(pl), pl) for pl in self.parsed)
+        return section
+
+    def header(self):
+        """return the section's own line, empty if the section doesn't have one"""
+        return ""
+
+    def original_header(self):
+        """return the text header() was parsed from"""
+        return ""
+
+    def original(self):
+        lines = [cl.original() for cl in self.parsed]
+        header = self.original_header()
+        if header:
+            lines.insert(0, header)
+        return "\n".join(lines)
+
+    def touched(self):
+        if self.modified or len(self.lines) != len(self.parsed):
+            return True
+
+        for cl, pl in itertools.izip(self.lines, self.parsed):
+            if cl is not pl or cl.touched():
+                return True
+
+        return False
+
+    def changed(self, line=None):
+        self._str = None
+        super(ConfigSection, self).changed(line)
+
+    @classmethod
+    def matches(cls, config, line):
+        return False
+
     def _parse(self, fp):
         pass
 
     def __str__(self):
-        s = "\n".join(str(cl) for cl in self.lines)
+        """the text of the section is cached until the section or one of its lines
+        is modified"""
+        s = self._str
+        if s is None:
+            s = self.render()
+            self._str = s
         return s
 
+    def render(self):
+        lines = [str(cl) for cl in self.lines]
+        header = self.header()
+        if header:
+            lines.insert(0, header)
+        return "\n".join(lines)
+
 
 class ConfigFile(object):
-    """This handles parsing the file internally"""
+    """This handles parsing the file internally
+
+    The file is read lazily, one line at a time, and only a small window of the
+    lines we've already handed out is kept around so rewind() can replay things
+    like postfix continuation lines, peek() lets a parser look at the next raw
+    line without consuming it
+    """
+    window = 16
+    """how many already consumed lines are kept so you can rewind() to them"""
+
     def __init__(self, path, config):
         self.path = path
         self.config = config
-        # we load the whole config file into memory because we hate memory and to
-        # punish it we like to use lots of it. Also, we were having some difficulty
-        # getting some conf files to parse correctly without being able to seek and
-        # stuff to certain lines and replay parts of the file and this was the 
-        # easiest solution to that problem
-        with open(self.path, "r") as fp:
-            self.lines = fp.readlines()
-            self.count = len(self.lines)
+        self.fp = open(self.path, "r")
+        self.reset()
 
+    def reset(self):
+        # buffer[0] is the raw line at line number self.offset
+        self.buffer = deque()
+        self.offset = 0
         self.line_number = -1
 
     def close(self):
         if not self.fp.closed:
             self.fp.close()
 
+    source = None
+    """the path of the file line spans point into, see MmapConfigFile"""
+
     def __iter__(self):
         return self
 
-    def __count__(self):
-        return self.count
+    def readline(self):
+        """return the next raw line from the source, or None when there are no
+        more lines"""
+        line = None
+        if not self.fp.closed:
+            line = self.fp.readline()
+            if not line:
+                line = None
+                self.close()
+        return line
+
+    def getline(self, line_number):
+        """return the stripped line at line_number, or None if the source doesn't
+        have that many lines"""
+        if line_number < self.offset:
+            raise ValueError("line {} is no longer buffered, only the last {} lines are kept".format(
+                line_number,
+                self.window
+            ))
+
+        while self.offset + len(self.buffer) <= line_number:
+            line = self.readline()
+            if line is None:
+                return None
+            self.buffer.append(line)
+
+        return self.buffer[line_number - self.offset].rstrip()
+
+    def peek(self):
+        """return the next line without consuming it, None if there isn't one"""
+        return self.getline(self.line_number + 1)
 
     def rewind(self, line_number):
+        if line_number + 1 < self.offset:
+            raise ValueError("cannot rewind to line {}, only the last {} lines are kept".format(
+                line_number,
+                self.window
+            ))
         self.line_number = line_number
 
+    def skip(self):
+        """consume the next raw line without building a line object for it, this
+        is handy for parsers that want to fold following lines into the current
+        one (see peek())
+
+        :returns: string, the stripped line, or None if there are no more lines
+        """
+        line = self.getline(self.line_number + 1)
+        if line is not None:
+            self.line_number += 1
+            while self.line_number - self.offset > self.window:
+                self.buffer.popleft()
+                self.offset += 1
+
+        return line
+
+    def build(self, line_class):
+        """consume the next line and parse it as line_class, for parsers that have
+        already classified the line with peek()"""
+        line = self.skip()
+        if line is None:
+            raise StopIteration()
+
+        self.line = line
+        c = line_class(self.config)
+        c.parse(self)
+        return c
+
     def next(self):
-        self.line_number += 1
-        if self.line_number >= self.count:
+        line = self.peek()
+        if line is None:
             raise StopIteration()
 
-        self.line = self.lines[self.line_number].rstrip()
+        return self.build(self.config.classify(line))
 
-        c = self.config.create_section()
-        c.parse(self)
-        if not c.is_valid():
-            c = self.config.create_option()
-            c.parse(self)
-            if not c.is_valid():
-                c = self.config.create_line()
-                c.parse(self)
 
+class MmapConfigFile(ConfigFile):
+    """Memory maps the file instead of reading it through a file object, meant for
+    really big files like alias and access tables, set it as the file_class of a
+    Config to use it
+
+    Every top level line remembers where it was in the file (its span) and the
+    file becomes the config's source, so Config.save() can copy any lines that
+    haven't been touched straight out of the file instead of rebuilding them. The
+    map is closed once the file is parsed, a map that is kept open would crash the
+    process if the file was truncated underneath it
+    """
+    def __init__(self, path, config):
+        self.path = path
+        self.config = config
+        self.fp = None
+        with open(self.path, "rb") as fp:
+            # empty files can't be mapped
+            if os.fstat(fp.fileno()).st_size:
+                self.fp = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self.source = self.path if self.fp is not None else None
+        self.reset()
+
+    def reset(self):
+        super(MmapConfigFile, self).reset()
+        # ends[i] is where the line in buffer[i] ends in the map
+        self.ends = deque()
+
+    def readline(self):
+        line = None
+        if self.fp is not None:
+            line = self.fp.readline()
+            if line:
+                self.ends.append(self.fp.tell())
+            else:
+                line = None
+        return line
+
+    def tell(self, line_number):
+        """return where line_number ends in the map"""
+        if line_number < 0:
+            return 0
+
+        # the buffer only ever loses lines from the front, so ends can be lined
+        # back up with it here instead of everywhere the buffer is trimmed
+        while len(self.ends) > len(self.buffer):
+            self.ends.popleft()
+
+        return self.ends[line_number - self.offset]
+
+    def next(self):
+        start = self.tell(self.line_number)
+        c = super(MmapConfigFile, self).next()
+        c.span = (start, self.tell(self.line_number))
         return c
 
+    def close(self):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+
 
 class ConfigBody(ConfigFile):
     def __init__(self, body, config):
         self.config = config
-        self.lines = body.splitlines(False)
-        self.count = len(self.lines)
-        self.line_number = -1
+        self.fp = iter(body.splitlines(False))
+        self.reset()
+
+    def readline(self):
+        return next(self.fp, None)
 
     def close(self): pass
 
@@ -380,6 +1402,7 @@ class Config(ConfigBase):
             opt = config["option"]
             opt.val = "value"
     """
+    __metaclass__ = ConfigMeta
 
     commenters = "#"
 
@@ -389,6 +1412,15 @@ class Config(ConfigBase):
     """If you need to do some custom name matching of the option, these get ran
     before the generic splitting on option_divider"""
 
+    lazy = False
+    """if True then options only find their name (and where their val starts)
+    while parsing, their val and comment are parsed from the line when they are
+    accessed instead of being kept around as copies"""
+
+    grammar_class = ConfigGrammar
+    """this will be compiled once for each Config class using commenters,
+    option_divider, and option_name_regexes, see ConfigMeta"""
+
     line_class = ConfigLine
 
     option_class = ConfigOption
@@ -403,6 +1435,24 @@ class Config(ConfigBase):
 
     prototype_path = ""
 
+    parsed = ()
+    """the lines as they were right after parsing, see diff()"""
+
+    source = None
+    """the path the file_class parsed from if it can be used to save untouched
+    lines, see MmapConfigFile and open_source()"""
+
+    cache = None
+    """set to a ConfigCache to reuse parsed files when the file hasn't changed,
+    only worth it where the same file is parsed over and over again"""
+
+    stamp = None
+    """the (size, mtime) of prototype_path when it was parsed, see refresh()"""
+
+    listeners = ()
+    """callables that are called with (config, line) every time changed() is, see
+    add_listener()"""
+
     def __init__(self, dest_path="", prototype_path=""):
         self.reset()
 
@@ -413,6 +1463,106 @@ class Config(ConfigBase):
         if dest_path:
             self.dest_path = dest_path
 
+    def reset(self):
+        super(Config, self).reset()
+        # see fork(), the lines this config might share with another config, and
+        # the copies own() made of them
+        self.shared = None
+        self.copies = {}
+
+    def reindex(self, lines):
+        shared = self.shared
+        if not shared:
+            return super(Config, self).reindex(lines)
+
+        # a shared line still belongs to the config it came from until own()
+        # copies it
+        parents = [(cl, cl.parent) for cl in lines if cl in shared]
+        super(Config, self).reindex(lines)
+        for cl, parent in parents:
+            cl.parent = parent
+
+    def fork(self):
+        """return a copy-on-write clone of this config
+
+        the clone starts out sharing all its line objects with this config, a
+        shared option or section is only copied when it is looked up by name (eg,
+        config["name"], find_options(), update()), so a fork costs about as much
+        as copying the lines index and each fork only pays for what it changes.
+        Lines reached by iterating over lines are still shared, use own() before
+        modifying one of those
+
+        :example:
+            base = Main(prototype_path="/etc/postfix/main.cf")
+            lockdown = base.fork()
+            lockdown["smtpd_helo_required"] = "yes"
+            relaxed = base.fork()
+            relaxed["smtpd_helo_required"] = "no"
+
+        :returns: Config, the same class as this config, diff() is against the
+            same parsed lines
+        """
+        if self.pending:
+            raise ValueError("cannot fork a config inside a batch()")
+
+        config = type(self)()
+        config.prototype_path = self.prototype_path
+        config.dest_path = self.dest_path
+        config.source = self.source
+        config.lines = self.lines.copy()
+        config.sections = defaultdict(list, ((k, list(v)) for k, v in self.sections.items()))
+        config.options = defaultdict(list, ((k, list(v)) for k, v in self.options.items()))
+        config.parsed = self.parsed
+        config.stamp = self.stamp
+        config.copies = dict(self.copies)
+        config._str = self._str
+
+        # lines hash by identity, keeping the lines themselves (instead of their
+        # ids) means an id can't be reused by another line while it's in here
+        shared = set(self.lines)
+        config.shared = shared
+        if self.shared is None:
+            self.shared = set(shared)
+        else:
+            self.shared |= shared
+        return config
+
+    def own(self, line):
+        """make sure line is not shared with another config, see fork()
+
+        :param line: ConfigLine, one of this config's lines
+        :returns: ConfigLine, line if it wasn't shared, otherwise the copy of line
+            that has replaced it in this config
+        """
+        shared = self.shared
+        if not shared or line not in shared:
+            return line
+
+        shared.discard(line)
+        copy = line.copy(self, self)
+        self.lines.replace(line, copy)
+        name = getattr(line, "name", None)
+        for index in (self.sections, self.options):
+            options = index.get(name)
+            if options and line in options:
+                options[options.index(line)] = copy
+
+        self.copies[line] = copy
+        return copy
+
+    def copied(self, line):
+        """return what line has been replaced with by own(), or line"""
+        copies = self.copies
+        while line in copies:
+            line = copies[line]
+        return line
+
+    def find_options(self, k):
+        options = super(Config, self).find_options(k)
+        if self.shared:
+            options = [self.own(o) for o in options]
+        return options
+
     def create_line(self):
         return self.line_class(self)
 
@@ -431,35 +1581,433 @@ class Config(ConfigBase):
 
         return sc
 
+    def classify(self, line):
+        """decide which of section_class, option_class, or line_class should parse
+        line, the classes are checked in that order using their matches() hook so
+        only the one object that is needed gets created
+
+        :param line: string, the raw line
+        :returns: the class that should parse line
+        """
+        for line_class in (self.section_class, self.option_class):
+            if line_class.matches(self, line):
+                return line_class
+        return self.line_class
+
     def create_file(self):
         return self.file_class(self.prototype_path, self)
 
     def parse(self):
-        fp = self.create_file()
         self.reset()
+        self.source = None
+        # taken before reading so an edit made while parsing is still caught by
+        # refresh()
+        self.stamp = self.file_stamp()
+
+        cache = self.cache
+        if cache:
+            stamp = cache.stamp(self.prototype_path)
+            if cache.load(self, stamp):
+                self.parsed = list(self.lines)
+                return
 
-        for line_number, c in enumerate(fp):
-            if isinstance(c, self.section_class):
-                self.sections[c.name].append(line_number)
-                self.lines.append(c)
+        fp = self.create_file()
+        try:
+            for c in fp:
+                self.append(c)
+
+        finally:
+            fp.close()
+
+        self.source = fp.source
+        self.parsed = list(self.lines)
+
+        if cache:
+            cache.save(self, stamp)
+
+    def file_stamp(self):
+        """return the (size, mtime) of prototype_path, None if it doesn't exist"""
+        try:
+            st = os.stat(self.prototype_path)
+        except OSError:
+            return None
+        return (st.st_size, st.st_mtime)
+
+    def refresh(self):
+        """bring the config up to date with changes another program made to
+        prototype_path since it was parsed, without parsing the whole file again
+
+        nothing is read if the size and modified time of the file are the same,
+        otherwise the text the top level lines were parsed from (see
+        ConfigLine.original()) is aligned with the file to find the hunks that
+        changed, only those hunks are parsed, and their new lines are spliced in
+        where the old ones were. Every line outside the hunks keeps its object and
+        any modifications made to it, lines inside them are replaced by what the
+        file has now
+
+        :returns: boolean, True if the config changed
+        """
+        if self.pending:
+            raise ValueError("cannot refresh a config inside a batch()")
+
+        stamp = self.file_stamp()
+        if stamp is not None and stamp == self.stamp:
+            return False
+
+        with open(self.prototype_path, "r") as fp:
+            body = fp.read()
+
+        # the same lines ConfigFile would have read
+        raw = [line.rstrip() for line in body.split("\n")] if body else []
+        if body.endswith("\n"):
+            raw.pop()
+
+        self.stamp = stamp
+        hunks = self.refresh_hunks(raw)
+        if not hunks:
+            return False
+
+        parsed = self.parsed
+        pieces = []
+        k = 0
+        for a, b, new in hunks:
+            self.splice([self.copied(pl) for pl in parsed[a:b]], new, parsed[b:])
+            pieces.append(parsed[k:a])
+            pieces.append(new)
+            k = b
+        pieces.append(parsed[k:])
+
+        self.parsed = list(itertools.chain.from_iterable(pieces))
+        # the spans of the lines that were kept point into the old file
+        self.source = None
+        return True
+
+    def refresh_hunks(self, raw):
+        """find the regions of the parsed lines that raw changed, see refresh()
+
+        :param raw: list, the lines the file has now
+        :returns: list, (a, b, new) tuples, the parsed lines a:b are replaced by
+            the lines in new, in order
+        """
+        parsed = self.parsed
+        texts = [pl.original().split("\n") for pl in parsed]
+        # starts[k] is where parsed[k] starts in the lines the file used to have
+        starts = [0]
+        for t in texts:
+            starts.append(starts[-1] + len(t))
+        old = list(itertools.chain.from_iterable(texts))
+
+        # the ends that didn't change are skipped before the lines are aligned
+        lo = 0
+        hi = min(len(old), len(raw))
+        while lo < hi and old[lo] == raw[lo]:
+            lo += 1
+        hi = 0
+        while hi < min(len(old), len(raw)) - lo and old[-1 - hi] == raw[-1 - hi]:
+            hi += 1
+
+        # each changed run of lines becomes a hunk of whole parsed lines [a, b)
+        # and the raw lines [start, stop) that they became
+        hunks = []
+        sm = difflib.SequenceMatcher(None, old[lo:len(old) - hi], raw[lo:len(raw) - hi], False)
+        for tag, i1, i2, j1, j2 in sm.get_opcodes():
+            if tag == "equal": continue
+            i1, i2, j1, j2 = i1 + lo, i2 + lo, j1 + lo, j2 + lo
+            a = bisect_right(starts, i1) - 1
+            b = bisect_left(starts, i2)
+            start = j1 - (i1 - starts[a])
+            stop = j2 + (starts[b] - i2)
+
+            # the line before the hunk could continue into it (eg, main.cf
+            # continuation lines or master.cf -o lines)
+            if a > 0:
+                a -= 1
+                start -= len(texts[a])
+
+            if hunks and a <= hunks[-1][1]:
+                a, start = hunks[-1][0], hunks[-1][2]
+                hunks.pop()
+
+            hunks.append([a, b, start, stop])
+
+        ret = []
+        while hunks:
+            a, b, start, stop = hunks.pop(0)
+
+            # and the hunk could continue into the lines after it (eg, a comment
+            # that became an option now owns the indented lines that follow it),
+            # so the hunk grows until it ends with a line that parsed exactly like
+            # it did before, the parser made the same choices there so everything
+            # after it lines up again
+            while True:
+                new = []
+                if start < stop:
+                    new = list(self.body_class("\n".join(raw[start:stop]) + "\n", self))
+
+                if b == len(parsed): break
+                if new and b > a and new[-1].original() == parsed[b - 1].original(): break
+
+                if hunks and hunks[0][0] == b:
+                    _, b, _, stop = hunks.pop(0)
+
+                else:
+                    stop += len(texts[b])
+                    b += 1
+
+            # the lines on the edges that parsed the same are kept
+            old_lines = parsed[a:b]
+            while old_lines and new and old_lines[0].original() == new[0].original():
+                old_lines.pop(0)
+                new.pop(0)
+                a += 1
+            while old_lines and new and old_lines[-1].original() == new[-1].original():
+                old_lines.pop()
+                new.pop()
+            b = a + len(old_lines)
+
+            if a < b or new:
+                ret.append((a, b, new))
+
+        return ret
+
+    def splice(self, old, new, after):
+        """replace the old lines with the new lines, see refresh()
+
+        :param old: list, the lines being replaced, the ones that have already
+            been removed from this config are skipped
+        :param new: list, the lines that take their place
+        :param after: list, the parsed lines that come after old, new is put in
+            front of the first one still in this config if none of old are
+        """
+        lines = self.lines
+        orders = lines.orders
+        old = [cl for cl in old if id(cl) in orders]
+        if old:
+            i = lines.index(old[0])
+
+        else:
+            i = len(lines)
+            for pl in after:
+                cl = self.copied(pl)
+                if id(cl) in orders:
+                    i = lines.index(cl)
+                    break
+
+        if (len(old) + len(new)) * ConfigBatch.merge_ratio < len(lines):
+            for cl in old:
+                self.remove(cl)
+            for k, cl in enumerate(new):
+                self.insert(i + k, cl)
+
+        else:
+            removed = set(id(cl) for cl in old)
+            self.reindex(
+                lines.lines[:i] + new + [cl for cl in lines.lines[i:] if id(cl) not in removed]
+            )
 
-            elif isinstance(c, self.option_class):
-                self.options[c.name].append(line_number)
-                self.lines.append(c)
- 
-            elif isinstance(c, self.line_class):
-                self.lines.append(c)
+    def diff(self, n=3):
+        """return a unified diff of everything that has changed since the config
+        was parsed
+
+        this doesn't compare the text of the whole file, lines that haven't been
+        touched (see ConfigLine.touched()) are known to be the same, so only the
+        text of the lines that changed, and the lines around them, is looked at
+
+        :param n: int, how many lines of context each hunk gets
+        :returns: string, the diff, empty if nothing changed
+        """
+        old = []
+        new = []
+        opcodes = []
+        def add(tag, old_text, new_text):
+            i1, j1 = len(old), len(new)
+            if old_text is not None: old.extend(old_text.split("\n"))
+            if new_text is not None: new.extend(new_text.split("\n"))
+            i2, j2 = len(old), len(new)
+            if opcodes and opcodes[-1][0] == tag:
+                _, i1, _, j1, _ = opcodes.pop()
+            opcodes.append((tag, i1, i2, j1, j2))
+
+        def walk(parsed, lines):
+            old_index = dict((id(cl), i) for i, cl in enumerate(parsed))
+            oi = 0
+            for cl in lines:
+                i = old_index.get(id(cl), -1)
+                if i < oi:
+                    # a new line (or one that has been moved back)
+                    add("insert", None, str(cl))
+                    continue
+
+                for pl in parsed[oi:i]:
+                    add("delete", pl.original(), None)
+
+                if not cl.touched():
+                    add("equal", cl.original(), cl.original())
+
+                elif isinstance(cl, ConfigSection):
+                    header = cl.original_header()
+                    if header:
+                        if cl.modified:
+                            add("replace", header, cl.header())
+                        else:
+                            add("equal", header, header)
+                    walk(cl.parsed, cl.lines)
+
+                else:
+                    add("replace", cl.original(), str(cl))
+
+                oi = i + 1
+
+            for pl in parsed[oi:]:
+                add("delete", pl.original(), None)
+
+        parsed = self.parsed
+        if self.copies:
+            parsed = [self.copied(pl) for pl in parsed]
+        walk(parsed, self.lines)
+
+        if all(tag == "equal" for tag, _, _, _, _ in opcodes):
+            return ""
+
+        return unified_diff(old, new, opcodes, self.prototype_path, self.dest_path, n)
+
+    def apply(self, patch):
+        """apply a diff() from another config with the same prototype to this
+        config, the patched text is then parsed again and becomes what future
+        diffs are against
+
+        :param patch: string, the unified diff
+        """
+        lines = str(self).split("\n") if len(self.lines) else []
+        # every line gets its newline so a blank last line isn't lost
+        body = "".join("{}\n".format(line) for line in patch_lines(lines, patch))
+
+        self.reset()
+        self.source = None
+        for c in self.body_class(body, self):
+            self.append(c)
+        self.parsed = list(self.lines)
+
+    def changed(self, line=None):
+        """see ConfigLine.changed(), line is None when all the lines were replaced"""
+        self._str = None
+        for listener in self.listeners:
+            listener(self, line)
+
+    def add_listener(self, listener):
+        """call listener(config, line) whenever a line in this config (or one of
+        its sections) is modified, added, or removed, line is None when all the
+        lines were replaced (eg, the config was parsed again)
+
+        forks don't inherit listeners
+        """
+        if not self.listeners:
+            self.listeners = []
+        self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
 
     def __str__(self):
-        return "\n".join((str(cl) for cl in self))
+        """see ConfigSection.__str__, the whole config's text is cached the same
+        way"""
+        s = self._str
+        if s is None:
+            s = "\n".join((str(cl) for cl in self))
+            self._str = s
+        return s
 
     def __iter__(self):
         for cl in self.lines:
             yield cl
 
+    def chunks(self, source, newline="\n"):
+        """yield the text of the config, runs of lines that haven't been touched
+        since they were parsed are copied from source in one read
+
+        :param source: file, the open source, see open_source()
+        :param newline: string, what the lines that are rendered end with, this is
+            what the source uses so the file doesn't end up with mixed endings
+        """
+        start = stop = None
+        for cl in self.lines:
+            span = cl.span
+            if span and span[0] == stop:
+                stop = span[1]
+                continue
+
+            if stop is not None:
+                yield self.chunk(source, start, stop, newline)
+
+            if span:
+                start, stop = span
+
+            else:
+                start = stop = None
+                s = "{}\n".format(cl)
+                yield s if newline == "\n" else s.replace("\n", newline)
+
+        if stop is not None:
+            yield self.chunk(source, start, stop, newline)
+
+    def chunk(self, source, start, stop, newline="\n"):
+        source.seek(start)
+        s = source.read(stop - start)
+        if len(s) < stop - start:
+            raise IOError("{} changed while it was being saved".format(self.source))
+
+        if not s.endswith("\n"):
+            # the last line of the file didn't have a newline
+            s += newline
+        return s
+
+    def open_source(self):
+        """return source opened for reading, or None if there is no source or it no
+        longer has the size and modified time it had when it was parsed, the line
+        spans wouldn't line up with it anymore"""
+        if self.source is None or self.stamp is None:
+            return None
+
+        try:
+            fp = open(self.source, "rb")
+        except IOError:
+            return None
+
+        st = os.fstat(fp.fileno())
+        if (st.st_size, st.st_mtime) != self.stamp:
+            fp.close()
+            return None
+
+        return fp
+
     def save(self):
-        with open(self.dest_path, "w") as f:
-            for cl in self:
-                f.write(str(cl))
-                f.write("\n")
+        """write the config out to dest_path, if dest_path already has exactly
+        these contents it is left alone, otherwise the contents are written to a
+        temp file that is then renamed over dest_path
+
+        :returns: boolean, True if dest_path changed
+        """
+        body = None
+        fp = self.open_source()
+        if fp is not None:
+            try:
+                newline = "\r\n" if fp.readline().endswith("\r\n") else "\n"
+                body = "".join(self.chunks(fp, newline))
+
+            except IOError:
+                # the file was changed underneath us, render it instead
+                body = None
+
+            finally:
+                fp.close()
+
+        if body is None:
+            body = "{}\n".format(self) if len(self.lines) else ""
+
+        if file_matches(self.dest_path, body):
+            return False
+
+        write_atomic(self.dest_path, body)
+        return True
 
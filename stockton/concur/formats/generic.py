@@ -11,6 +11,8 @@ import base
 
 
 class EqualOption(base.ConfigOption):
+    __slots__ = ()
+
     def format_set(self, name, divider, val):
         option_set_format = "{} {} {}" # key = val
         s = option_set_format.format(name, divider, val)
@@ -29,6 +31,8 @@ class EqualConfig(base.Config):
 
 
 class ColonOption(base.ConfigOption):
+    __slots__ = ()
+
     def format_set(self, name, divider, val):
         option_set_format = "{}{} {}" # key: val
         s = option_set_format.format(name, divider, val)
@@ -47,13 +51,10 @@ class ColonConfig(base.Config):
 
 
 class SpaceOption(base.ConfigOption):
+    __slots__ = ()
+
     def format_set(self, name, divider, val):
-        option_set_format = "{}{}" # key val
-        s = option_set_format.format(
-            name.ljust(max(self.config.option_buffer, len(name) + 1), " "),
-            val
-        )
-        return s
+        return self.config.format_option(name, val)
 
 
 class SpaceConfig(base.Config):
@@ -67,3 +68,33 @@ class SpaceConfig(base.Config):
     option_buffer = 24
     option_class = SpaceOption
 
+    @classmethod
+    def format_option(cls, name, val):
+        option_set_format = "{}{}" # key val
+        s = option_set_format.format(
+            name.ljust(max(cls.option_buffer, len(name) + 1), " "),
+            val
+        )
+        return s
+
+    @classmethod
+    def write_options(cls, path, options):
+        """write (name, val) options straight to path without parsing or building
+        any lines, this is for generated files like alias maps that can have a
+        lot of entries, the lines look exactly like they would if they had been
+        set on a config and saved
+
+        :param path: string, the file that will be replaced
+        :param options: iterable, (name, val) tuples, this is only iterated once
+        :returns: int, how many options were written
+        """
+        count = [0]
+        def body(fp):
+            for name, val in options:
+                fp.write(cls.format_option(name, val))
+                fp.write("\n")
+                count[0] += 1
+
+        base.write_atomic(path, body)
+        return count[0]
+
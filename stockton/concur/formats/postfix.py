@@ -2,78 +2,230 @@
 Postfix specific configuration files, the file locations are for ubuntu 14.04
 """
 import re
+import operator
+from collections import defaultdict
 
 from . import generic
 from . import base
 
 
 class MainOption(base.ConfigOption):
+    __slots__ = ()
+
+    @classmethod
+    def matches(cls, config, line):
+        # indented lines are always continuations of the option above
+        if line[:1].isspace(): return False
+        return super(MainOption, cls).matches(config, line)
+
     def _parse(self, fp):
         super(MainOption, self)._parse(fp)
         if self.is_valid():
-            # let's make sure we don't have a multiline
-            line_number = fp.line_number
-            for c in fp:
-                m = re.match("^\s+(\S+)", c.line)
-                if m:
-                    line = "\n" + fp.line
-                    self.val += line
-                    self.line += line
-                    line_number += 1
-
+            # let's make sure we don't have a multiline, the raw lines are checked
+            # so nothing is built for the continuation lines
+            parts = []
+            while True:
+                line = fp.peek()
+                if line and line[:1].isspace() and line.strip():
+                    parts.append(fp.skip())
                 else:
-                    #self.lines = re.split(",?\s*", self.val, re.M)
-                    fp.rewind(line_number)
                     break
 
+            if parts:
+                continuation = "\n" + "\n".join(parts)
+                if isinstance(self._val, basestring):
+                    self._val += continuation
+                self.line += continuation
+
 
 class Main(generic.EqualConfig):
+    lazy = True
     option_class = MainOption
     dest_path = "/etc/postfix/main.cf"
     # /usr/share/postfix/main.cf.dist has a rather complete example file
 
+    reference_regex = re.compile(r"\$(?:\{(\w+)\}|\((\w+)\)|(\w+))")
+    """matches $name, ${name}, and $(name)"""
+
+    def reset(self):
+        # name -> expanded val, see resolve()
+        self.expanded = {}
+        # name -> the names whose expanded vals used it
+        self.dependents = defaultdict(set)
+        super(Main, self).reset()
+
+    def changed(self, line=None):
+        super(Main, self).changed(line)
+        name = getattr(line, "name", None)
+        if name:
+            self.invalidate(name)
+
+        elif line is None:
+            self.expanded.clear()
+            self.dependents.clear()
+
+    def invalidate(self, name):
+        """forget the expanded val of name and everything that used it"""
+        names = [name]
+        while names:
+            name = names.pop()
+            self.expanded.pop(name, None)
+            names.extend(self.dependents.pop(name, ()))
+
+    def raw(self, name):
+        """return the val postfix would use for name, the last option set that
+        isn't commented out, or None if it isn't set"""
+        commenters = self.commenters
+        for option in reversed(self.find_options(name)):
+            if option.modified or not option.line.startswith(tuple(commenters)):
+                return option.val
+
+    def resolve(self, name):
+        """return the val of name with all the $name, ${name}, and $(name)
+        references in it expanded, the way postconf -x would
+
+        expanded vals are remembered until one of the options they used changes,
+        references to parameters that aren't set (postfix's defaults) are left alone
+
+        :returns: string, None if name isn't set
+        :raises: ValueError if the references go in a circle
+        """
+        return self.resolve_path(name, ())
+
+    def resolve_path(self, name, path):
+        if name in self.expanded:
+            return self.expanded[name]
+
+        if name in path:
+            raise ValueError("parameter {} references itself: {}".format(
+                name,
+                " -> ".join(path + (name,))
+            ))
+
+        val = self.raw(name)
+        if val is not None:
+            val = self.expand("{}".format(val), name, path + (name,))
+            self.expanded[name] = val
+        return val
+
+    def expand(self, val, name="", path=()):
+        """expand all the parameter references in val
+
+        :param val: string, something like btree:${data_directory}/smtpd_scache
+        :returns: string
+        """
+        def callback(m):
+            reference = m.group(1) or m.group(2) or m.group(3)
+            if name:
+                self.dependents[reference].add(name)
+            v = self.resolve_path(reference, path)
+            return m.group(0) if v is None else v
+
+        return self.reference_regex.sub(callback, val)
+
 
 class SMTPd(generic.ColonConfig):
     dest_path = "/etc/postfix/sasl/smtpd.conf"
 
 
+class MasterGrammar(base.ConfigGrammar):
+    def __init__(self, config_class):
+        super(MasterGrammar, self).__init__(config_class)
+        commenters = config_class.commenters
+        divider = config_class.option_divider
+
+        self.section_hint_regex = re.compile("\s+-\s+")
+        # service type  private unpriv  chroot  wakeup  maxproc command + args",
+        self.section_regex = re.compile("^(\S+)\s+(\S+)\s+(\S+)\s+(\S+)\s+(\S+)\s+(\S+)\s+(\S+)\s+(\S+)")
+        self.override_regex = re.compile("^[{}]?\s*-o\s+(\S+)\s*{}\s*(.*)".format(commenters, divider))
+
+
+def service_property(name):
+    """like base.tracked_property but also lets the config know its service index
+    is out of date, see Master.services"""
+    attr = "_{}".format(name)
+    def fset(self, v):
+        setattr(self, attr, v)
+        self.modified = True
+        self.config.services_index = None
+    return property(operator.attrgetter(attr), fset)
+
+
 class MasterSection(base.ConfigSection):
+    __slots__ = (
+        "start_line_number",
+        "stop_line_number",
+        "_service_type",
+        "_private",
+        "_unpriv",
+        "_chroot",
+        "_wakeup",
+        "_maxproc",
+        "_cmd",
+    )
+
+    name = service_property("name")
+
+    service_type = service_property("service_type")
+
+    private = base.tracked_property("private")
+
+    unpriv = base.tracked_property("unpriv")
+
+    chroot = base.tracked_property("chroot")
+
+    wakeup = base.tracked_property("wakeup")
+
+    maxproc = base.tracked_property("maxproc")
+
+    cmd = service_property("cmd")
+
+    @classmethod
+    def matches(cls, config, line):
+        grammar = config.grammar
+        if not grammar.section_hint_regex.search(line): return False
+        m = grammar.section_regex.match(line)
+        return bool(m and m.group(1).lstrip(config.commenters).lstrip())
+
     def _parse(self, fp):
-        if not re.search("\s+-\s+", fp.line): return
+        grammar = self.config.grammar
+        if not grammar.section_hint_regex.search(fp.line): return
 
         self.reset()
         commenters = self.config.commenters
 
-        # service type  private unpriv  chroot  wakeup  maxproc command + args",
-        m = re.match("^(\S+)\s+(\S+)\s+(\S+)\s+(\S+)\s+(\S+)\s+(\S+)\s+(\S+)\s+(\S+)", fp.line)
+        m = grammar.section_regex.match(fp.line)
         if m:
             self.line = fp.line
             self.start_line_number = fp.line_number
             self.stop_line_number = self.start_line_number
 
-            self.name = m.group(1).lstrip(commenters).lstrip()
-            self.service_type = m.group(2)
-            self.private = m.group(3)
-            self.unpriv = m.group(4)
-            self.chroot = m.group(5)
-            self.wakeup = m.group(6)
-            self.maxproc = m.group(7)
-            self.cmd = m.group(8)
-
-            for line_number, c in enumerate(fp):
-                if isinstance(c, self.config.section_class):
-                    self.stop_line_number = c.start_line_number - 1
-                    fp.rewind(self.stop_line_number)
-                    break
+            # these are mostly the same few values over and over
+            intern_name = base.intern_name
+            self._name = intern_name(m.group(1).lstrip(commenters).lstrip())
+            self._service_type = intern_name(m.group(2))
+            self._private = intern_name(m.group(3))
+            self._unpriv = intern_name(m.group(4))
+            self._chroot = intern_name(m.group(5))
+            self._wakeup = intern_name(m.group(6))
+            self._maxproc = intern_name(m.group(7))
+            self._cmd = intern_name(m.group(8))
 
-                elif isinstance(c, self.config.option_class):
-                    self.options[c.name].append(line_number)
-                    self.lines.append(c)
+            # we stop right before the next section so we never have to rewind
+            # back across a section boundary
+            section_class = self.config.section_class
+            while True:
+                line = fp.peek()
+                if line is None: break
 
-                elif isinstance(c, self.config.line_class):
-                    self.lines.append(c)
+                line_class = self.config.classify(line)
+                if line_class is section_class: break
 
-    def __str__(self):
+                self.append(fp.build(line_class))
+
+            self.stop_line_number = fp.line_number
+
+    def header(self):
         if self.modified:
             s = "{}{}{}{}{}{}{}{}".format(
                 self.name.ljust(max(10, len(self.name) + 1)),
@@ -89,23 +241,27 @@ class MasterSection(base.ConfigSection):
         else:
             s = self.line
 
-        s2 = super(MasterSection, self).__str__()
-        if s2:
-            s += "\n" + s2
         return s
 
+    def original_header(self):
+        return self.line
+
 
 class MasterOption(base.ConfigOption):
+    __slots__ = ()
+
+    @classmethod
+    def matches(cls, config, line):
+        return "-o" in line
+
     def _parse(self, fp):
         if "-o" in fp.line:
-            self.name = fp.line
+            self._name = fp.line
 
-        commenters = self.config.commenters
-        divider = self.config.option_divider
-        m = re.match("^[{}]?\s*-o\s+(\S+)\s*{}\s*(.*)".format(commenters, divider), fp.line)
+        m = self.config.grammar.override_regex.match(fp.line)
         if m:
-            self.name = m.group(1)
-            self.val = m.group(2)
+            self._name = base.intern_name(m.group(1))
+            self._val = m.group(2)
 
     def format_set(self, name, divider, val):
         s = "  -o {}{}{}".format(name, divider, val)
@@ -113,14 +269,179 @@ class MasterOption(base.ConfigOption):
 
 
 class MasterLine(base.ConfigLine):
+    __slots__ = ()
+
     def __str__(self):
-        # TODO -- test this with an existing line to make sure it doesn't double indent
+        # parsed lines (like the comments at the top of master.cf) are left the
+        # way they were, only the lines that were added get indented
+        if not self.modified:
+            return self.line
         return "  {}".format(self.line.lstrip())
 
 
 class Master(base.Config):
+    grammar_class = MasterGrammar
     section_class = MasterSection
     option_class = MasterOption
     line_class = MasterLine
     dest_path = "/etc/postfix/master.cf"
 
+    def reset(self):
+        super(Master, self).reset()
+        self.services_index = None
+
+    def index_option(self, option):
+        super(Master, self).index_option(option)
+        self.services_index = None
+
+    def remove(self, option):
+        super(Master, self).remove(option)
+        self.services_index = None
+
+    def own(self, line):
+        copy = super(Master, self).own(line)
+        if copy is not line:
+            self.services_index = None
+        return copy
+
+    @property
+    def services(self):
+        """the service index, this is built the first time it is needed after the
+        services have changed
+
+        :returns: tuple, ({(service, type): [sections]}, {cmd: [sections]}), the
+            sections are in the order they appear in the file
+        """
+        if self.services_index is None:
+            by_service = defaultdict(list)
+            by_cmd = defaultdict(list)
+            for section in self.lines:
+                if isinstance(section, MasterSection):
+                    by_service[(section.name, section.service_type)].append(section)
+                    by_cmd[section.cmd].append(section)
+            self.services_index = (by_service, by_cmd)
+
+        return self.services_index
+
+    def find_service(self, name, service_type):
+        """return the first service section for name and service_type (eg, "smtp",
+        "inet"), or None"""
+        sections = self.services[0].get((name, service_type))
+        return self.own(sections[0]) if sections else None
+
+    def find_command(self, cmd, name=""):
+        """return all the service sections that run cmd (eg, "smtpd"), if name is
+        given then only services with that name are returned
+
+        :returns: list
+        """
+        sections = self.services[1].get(cmd, [])
+        if name:
+            sections = [s for s in sections if s.name == name]
+        return [self.own(s) for s in sections]
+
+
+
+class EffectiveConfig(object):
+    """The settings postfix actually runs each service with, the main.cf
+    parameters with the service's master.cf -o overrides on top of them
+
+    the overrides of every service are indexed the first time they are needed,
+    after that the index follows the configs (see Config.add_listener()), a
+    change to one service's overrides only re-indexes that service
+
+    :example:
+        e = EffectiveConfig(Main(prototype_path=...), Master(prototype_path=...))
+        e.get("smtpd_tls_security_level", "submission")
+    """
+    def __init__(self, main, master):
+        self.main = main
+        self.master = master
+        # (service, type) -> {name: raw val}, see service_overrides()
+        self.overrides = None
+        # (service, type) -> {name: expanded val}
+        self.values = {}
+
+        main.add_listener(self.main_changed)
+        master.add_listener(self.master_changed)
+
+    def close(self):
+        """stop following the configs"""
+        self.main.remove_listener(self.main_changed)
+        self.master.remove_listener(self.master_changed)
+
+    def is_active(self, line):
+        """return True if line isn't commented out"""
+        return line.modified or not line.line.lstrip().startswith(tuple(self.master.commenters))
+
+    def find_section(self, key):
+        """return the first section for the (service, type) key that isn't
+        commented out, or None"""
+        for section in self.master.services[0].get(key, ()):
+            if self.is_active(section):
+                return section
+
+    def index_section(self, key, section):
+        overrides = {}
+        if section is not None:
+            for option in section.lines:
+                if isinstance(option, MasterOption) and option.name and self.is_active(option):
+                    overrides[option.name] = option.val
+        self.overrides[key] = overrides
+        self.values.pop(key, None)
+
+    def build(self):
+        """index the overrides of every service in master"""
+        self.overrides = {}
+        self.values = {}
+        for key in self.master.services[0]:
+            self.index_section(key, self.find_section(key))
+
+    def service_overrides(self, service, service_type="inet"):
+        """return the -o overrides of a service
+
+        :returns: dict, {name: val}, the vals are raw, empty if the service
+            doesn't exist
+        """
+        if self.overrides is None:
+            self.build()
+        return self.overrides.get((service, service_type), {})
+
+    def get(self, name, service="", service_type="inet", default=None):
+        """return the value of parameter name the service (eg "submission") runs
+        with, the value is expanded like Main.resolve()
+
+        :param service: string, if empty then only main.cf is checked
+        :param default: returned if name isn't set, which means postfix will use
+            its own default
+        """
+        if service:
+            overrides = self.service_overrides(service, service_type)
+            if name in overrides:
+                key = (service, service_type)
+                values = self.values.setdefault(key, {})
+                if name not in values:
+                    values[name] = self.main.expand("{}".format(overrides[name]))
+                return values[name]
+
+        v = self.main.resolve(name)
+        return default if v is None else v
+
+    def main_changed(self, config, line):
+        # an expanded override can use any main.cf parameter
+        self.values.clear()
+
+    def master_changed(self, config, line):
+        if self.overrides is None: return
+
+        if line is None or isinstance(line, MasterSection):
+            # a service was added, removed, or renamed
+            self.overrides = None
+            return
+
+        # removed lines still have their parent when listeners are told
+        parent = line.parent
+        if not isinstance(parent, MasterSection): return
+
+        key = (parent.name, parent.service_type)
+        self.index_section(key, self.find_section(key))
@@ -8,6 +8,8 @@ from . import base
 
 
 class SpamAssassinOption(base.ConfigOption):
+    __slots__ = ()
+
     def format_set(self, name, divider, val):
         option_set_format = "{}{}{}" # key=val
         s = option_set_format.format(name, divider, val)
@@ -22,7 +24,11 @@ class SpamAssassin(generic.EqualConfig):
 class Local(generic.SpaceConfig):
     dest_path = "/etc/spamassassin/local.cf"
     option_name_regexes = [
-        "^score\s+[A-Z0-9_]+"
+        "^score\s+[A-Z0-9_]+",
+        "^describe\s+[A-Z0-9_]+",
+        "^header\s+[A-Z0-9_]+",
+        "^body\s+[A-Z0-9_]+",
+        "^meta\s+[A-Z0-9_]+",
     ]
 
     def update_option(self, option, v):
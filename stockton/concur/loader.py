@@ -0,0 +1,60 @@
+"""
+Parses a bunch of config files at the same time so a command can load everything
+it is going to touch up front, see load()
+"""
+from multiprocessing.pool import ThreadPool, Pool
+
+
+def parse(spec):
+    """parse one config, this is what the pool runs
+
+    :param spec: tuple, (config_class, prototype_path, dest_path)
+    :returns: Config
+    """
+    config_class, prototype_path, dest_path = spec
+    return config_class(prototype_path=prototype_path, dest_path=dest_path)
+
+
+def load(configs, processes=None, pool_class=Pool):
+    """parse all the configs concurrently
+
+    :example:
+        configs = load({
+            "main": (Main, "/etc/postfix/main.cf"),
+            "master": (Master, "/etc/postfix/master.cf"),
+        })
+        configs["main"].update(...)
+
+    :param configs: dict, {key: (config_class, prototype_path)}, the tuple can also
+        have a dest_path on the end
+    :param processes: int, how big the pool is, defaults to one for each config
+    :param pool_class: multiprocessing.Pool by default, parsing is cpu bound so
+        threads would just take turns holding the GIL, the price is that the
+        configs have to be pickled back to this process. ThreadPool (see
+        load_threads()) is only worth it when most of the time is spent waiting
+        on the disk
+    :returns: dict, {key: Config}, the configs are in the same state as if they
+        had been created one at a time
+    """
+    keys = []
+    specs = []
+    for key, spec in configs.items():
+        config_class, prototype_path = spec[:2]
+        dest_path = spec[2] if len(spec) > 2 else ""
+        keys.append(key)
+        specs.append((config_class, prototype_path, dest_path))
+
+    if not specs: return {}
+
+    pool = pool_class(processes or len(specs))
+    try:
+        return dict(zip(keys, pool.map(parse, specs)))
+
+    finally:
+        pool.close()
+        pool.join()
+
+
+def load_threads(configs, processes=None):
+    """load() with a thread pool"""
+    return load(configs, processes, ThreadPool)
@@ -1,46 +1,70 @@
-from ..path import Filepath, Dirpath
+from ..path import Filepath, Dirpath, Snapshots
 
 class Interface(object):
+    snapshots_d = "/var/lib/stockton/snapshots"
+    """every interface keeps its snapshots in its own store under here"""
+
+    @property
+    def snapshots(self):
+        """this interface's snapshot store, each interface gets its own so
+        base_clear() on one interface never touches another's snapshots"""
+        snapshots = self.__dict__.get("_snapshots")
+        if snapshots is None:
+            d = Dirpath(self.snapshots_d, self.__class__.__name__.lower())
+            snapshots = Snapshots(d.path)
+            self._snapshots = snapshots
+        return snapshots
+
     def base_configs(self):
         return []
 
+    def base_legacy(self, name, f):
+        """return the files older versions used to keep the name backup of f in"""
+        return [
+            Filepath("{}.{}.base".format(f.path, name)),
+            Filepath("{}.{}.bak".format(f.path, name)),
+        ]
+
+    def base_import(self, name, configs):
+        """move backups older versions left next to configs into snapshot name,
+        a file that is already in the snapshot keeps its snapshot"""
+        snapshot = self.snapshots.get(name)
+        for f in configs:
+            if f.path in snapshot: continue
+            for legacy_f in self.base_legacy(name, f):
+                if legacy_f.exists():
+                    self.snapshots.add(name, f, legacy_f)
+                    legacy_f.delete()
+                    break
+
     def base_get(self, name, configs=None):
+        """return the snapshotted copies of configs in snapshot name"""
         if not configs:
             configs = self.base_configs()
 
-        base_fs = []
-        for f in configs:
-            base_fs.append(Filepath("{}.{}.base".format(f.path, name)))
-
-        return base_fs
+        self.base_import(name, configs)
+        snapshot = self.snapshots.get(name)
+        return [snapshot[f.path] for f in configs if f.path in snapshot]
 
     def base_create(self, name, configs=None):
-        """create a snapshot of the relevant config files so we could restore if needed"""
+        """create a snapshot of the relevant config files so we could restore if
+        needed, files that are already in the snapshot are left alone"""
         if not configs:
             configs = self.base_configs()
 
-        base_fs = []
-        for f in configs:
-            if f.exists():
-                base_f = f.backup(suffix=".{}.base".format(name), ignore_existing=False)
-                base_fs.append(base_f)
-
-        return base_fs
+        self.base_import(name, configs)
+        return self.snapshots.create(name, configs, ignore_existing=False)
 
     def base_restore(self, name, configs=None):
         """restore a snapshot of the base"""
         if not configs:
             configs = self.base_configs()
 
-        for f in configs:
-            base_f = Filepath("{}.{}.base".format(f.path, name))
-            if base_f.exists():
-                base_f.copy(f)
+        self.base_import(name, configs)
+        self.snapshots.restore(name, configs)
 
     def base_clear(self, name=""):
-        for f in self.base_configs():
-            d = f.directory
-            d.delete_files("{}.base$".format(name))
+        self.snapshots.clear(name)
 
     def reset(self):
         """Set it back completely fresh, you should never use this unless you know
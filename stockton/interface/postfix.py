@@ -1,3 +1,4 @@
+import os
 import re
 import time
 
@@ -7,6 +8,7 @@ from .. import cli
 from ..path import Filepath, Dirpath
 from ..concur.formats.postfix import Main, SMTPd, Master
 from ..concur.formats.generic import SpaceConfig
+from ..concur.formats.base import write_atomic
 from ..geo import IP
 from .base import Interface
 
@@ -121,6 +123,13 @@ class Postfix(Interface):
     def addresses_d(self):
         return Dirpath(self.virtual_d, "addresses")
 
+    @property
+    def aliases_f(self):
+        """the merged virtual alias map, when this exists every domain's addresses
+        are compiled into it and it is the only table in virtual_alias_maps, see
+        add_domain()"""
+        return Filepath(self.virtual_d, "aliases")
+
     @property
     def domains_f(self):
         return Filepath(self.virtual_d, "domains")
@@ -168,7 +177,14 @@ class Postfix(Interface):
 
         return domain
 
-    def delete_domain(self, domain):
+    def delete_domain(self, domain, merge=None):
+        """remove domain from postfix
+
+        :param merge: boolean, see add_domain()
+        """
+        if merge is None:
+            merge = self.aliases_f.exists()
+
         # remove postfix settings
         virtual_d = self.virtual_d
 
@@ -178,16 +194,36 @@ class Postfix(Interface):
         addresses_d = self.addresses_d
         addresses_d.delete_files("^{}".format(domain))
 
-        domain_hashes = []
-        for d in domains_f.lines():
-            domain_f = Filepath(addresses_d, d)
-            domain_hashes.append("hash:{}".format(domain_f.path))
+        if merge:
+            if self.aliases_f.exists():
+                self.merge_domain(domain)
+            else:
+                self.compile_aliases()
+            virtual_alias_maps = "hash:{}".format(self.aliases_f)
+
+        else:
+            domain_hashes = []
+            for d in domains_f.lines():
+                domain_f = Filepath(addresses_d, d)
+                domain_hashes.append("hash:{}".format(domain_f.path))
+            virtual_alias_maps = ",\n  ".join(domain_hashes)
 
         m = self.main()
-        m["virtual_alias_maps"] = ",\n  ".join(domain_hashes)
+        m["virtual_alias_maps"] = virtual_alias_maps
         m.save()
 
-    def add_domain(self, domain, proxy_file, proxy_email):
+    def add_domain(self, domain, proxy_file, proxy_email, merge=None):
+        """add domain to postfix, its addresses are kept in their own file in
+        addresses_d
+
+        :param merge: boolean, if True then all the domains' addresses are also
+            compiled into one merged map (aliases_f) so postfix only has to look an
+            address up in one table instead of probing a table for every domain,
+            None (the default) merges if the merged map already exists
+        """
+        if merge is None:
+            merge = self.aliases_f.exists()
+
         if not proxy_file:
             if not domain or not proxy_email:
                 raise ValueError("Either pass in proxy_file or (domain and proxy_emails)")
@@ -217,29 +253,121 @@ class Postfix(Interface):
         elif proxy_email:
             echo.h3("Adding catchall for {} routing to {}", domain, proxy_email)
             domain_f = Filepath(addresses_d, domain)
-            domain_c = SpaceConfig(dest_path=domain_f.path)
-            domain_c["@{}".format(domain)] = proxy_email
-            domain_c.save()
+            SpaceConfig.write_options(domain_f.path, [("@{}".format(domain), proxy_email)])
             new_domains.add(domain)
 
         domains_f.writelines(old_domains.union(new_domains))
 
+        if merge:
+            if self.aliases_f.exists():
+                for domain in new_domains:
+                    self.merge_domain(domain)
+            else:
+                self.compile_aliases()
+            virtual_alias_maps = "hash:{}".format(self.aliases_f)
+
+        else:
+            virtual_alias_maps = ",\n  ".join(("hash:{}".format(af) for af in self.addresses))
+
         # this is an additive editing of the conf file, so we use the active conf
         # as the prototype
         m = self.main()
         m.update(
             ("virtual_alias_domains", domains_f.path),
-            ("virtual_alias_maps", ",\n  ".join(("hash:{}".format(af) for af in self.addresses)))
+            ("virtual_alias_maps", virtual_alias_maps)
         )
         m.save()
 
-        for domain in new_domains:
-            cli.run("postmap {}".format(self.address(domain)))
+        if not merge:
+            for domain in new_domains:
+                cli.run("postmap {}".format(self.address(domain)))
 
     def address(self, domain):
         addresses_f = Filepath(self.addresses_d, domain)
         return addresses_f
 
+    def address_entries(self, domain):
+        """return the alias lines of domain's addresses file, without the blank
+        lines and comments, empty if the file doesn't exist"""
+        entries = []
+        try:
+            for line in self.address(domain).lines():
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    entries.append(line)
+
+        except IOError:
+            pass
+
+        return entries
+
+    def compile_aliases(self):
+        """write every domain's addresses into the merged map and build its whole
+        table, each domain's entries follow a "# domain <domain>" line so
+        merge_domain() can find them again"""
+        aliases_f = self.aliases_f
+        def body(fp):
+            for domain in sorted(self.domains):
+                entries = self.address_entries(domain)
+                if entries:
+                    fp.write("# domain {}\n".format(domain))
+                    fp.write("".join("{}\n".format(entry) for entry in entries))
+
+        write_atomic(aliases_f.path, body)
+        cli.run("postmap hash:{}".format(aliases_f))
+
+    def merge_domain(self, domain):
+        """replace just domain's entries in the merged map with what its addresses
+        file has now (if the file is gone the entries are removed), only the
+        entries that changed are updated in the table"""
+        aliases_f = self.aliases_f
+        marker = "# domain {}".format(domain)
+        lines = []
+        old = []
+        i = None
+        block = False
+        for line in aliases_f.lines():
+            if line.startswith("# domain "):
+                block = line == marker
+                if block:
+                    i = len(lines)
+                    continue
+
+            if block:
+                old.append(line)
+            else:
+                lines.append(line)
+
+        new = self.address_entries(domain)
+        if new:
+            if i is None: i = len(lines)
+            lines[i:i] = [marker] + new
+
+        write_atomic(aliases_f.path, "".join("{}\n".format(line) for line in lines))
+
+        if os.path.isfile("{}.db".format(aliases_f)):
+            old = dict((entry.split(None, 1)[0], entry) for entry in old if entry.strip())
+            new = dict((entry.split(None, 1)[0], entry) for entry in new)
+            deleted = [k for k in old if k not in new]
+            changed = [entry for k, entry in new.items() if old.get(k) != entry]
+            if deleted:
+                self.postmap("-d -", deleted)
+            if changed:
+                self.postmap("-i", changed)
+
+        else:
+            cli.run("postmap hash:{}".format(aliases_f))
+
+    def postmap(self, flags, lines):
+        """run postmap on the merged map with lines as its input"""
+        input_f = Filepath.create_temp("stockton-postmap-{}".format(os.getpid()))
+        try:
+            input_f.writelines(lines)
+            cli.run("postmap {} hash:{} < {}".format(flags, self.aliases_f, input_f))
+
+        finally:
+            input_f.delete()
+
     def main(self, path=Main.dest_path):
         return Main(prototype_path=path)
 
@@ -248,10 +376,26 @@ class Postfix(Interface):
         return Master(prototype_path=path)
 
     def main_backups(self):
-        """return any backups of the Postfix main.cf file"""
-        for mbak_f in self.config_d.files("main.*?\.bak$"):
-            mbak = Main(dest_path=mbak_f.path, prototype_path=mbak_f.path)
-            yield mbak
+        """return any snapshots of the Postfix main.cf file, main.cf.*.bak backups
+        left by older versions are imported into the snapshots first
+
+        the snapshots are listed straight from the index without being parsed,
+        pass the path of the one you want to main() to parse it, that config still
+        saves to the live main.cf (this is how lockdown starts over from its
+        snapshot), never save to the blob itself
+
+        :returns: generator, (snapshot name, blob Filepath) tuples
+        """
+        main_f = self.main_f
+        regex = r"^{}\.(.+)\.bak$".format(re.escape(main_f.name))
+        for mbak_f in self.config_d.files(regex):
+            name = re.match(regex, mbak_f.name).group(1)
+            self.base_import(name, [main_f])
+
+        for name in self.snapshots.names():
+            snapshot = self.snapshots.get(name)
+            if main_f.path in snapshot:
+                yield name, snapshot[main_f.path]
 
     def _run(self, cmd):
         """this wraps the normal command in a command that will make sure it works"""
@@ -8,6 +8,7 @@ import datetime
 import tempfile
 from contextlib import contextmanager
 import hashlib
+import json
 
 
 class Path(object):
@@ -403,3 +404,162 @@ class Sentinal(object):
     def __nonzero__(self):
         return self.exists()
 
+
+
+class Snapshots(object):
+    """Content addressed store of config file snapshots
+
+    every snapshotted file is kept once, named by the md5 hash of its contents, in
+    the blobs directory, and the index file maps each snapshot name to the
+    {path: hash} of the files it saved. The index also remembers the size and
+    modified time each path had when it was last hashed so snapshotting a file
+    that hasn't changed is just a stat
+    """
+    blocksize = 204800
+
+    def __init__(self, directory="/var/lib/stockton/snapshots"):
+        self.directory = Dirpath(directory)
+        self.blobs_d = Dirpath(self.directory.path, "blobs")
+        self.index_f = Filepath(self.directory.path, "index.json")
+        self._index = None
+
+    @property
+    def index(self):
+        if self._index is None:
+            try:
+                with open(self.index_f.path) as fp:
+                    self._index = json.load(fp)
+
+            except (IOError, ValueError):
+                self._index = {}
+
+            self._index.setdefault("snapshots", {})
+            self._index.setdefault("stats", {})
+
+        return self._index
+
+    def save_index(self):
+        self.directory.create()
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory.path)
+        with os.fdopen(fd, "w") as fp:
+            json.dump(self.index, fp, indent=2, sort_keys=True)
+        os.rename(tmp_path, self.index_f.path)
+
+    def blob(self, h):
+        """return the Filepath where the contents with hash h are kept"""
+        return Filepath(self.blobs_d.path, h)
+
+    def hash(self, f):
+        """return the hash of f's contents, only reading f if its size or modified
+        time are different than the last time it was hashed"""
+        st = os.stat(f.path)
+        stats = self.index["stats"]
+        stat = stats.get(f.path)
+        if stat and stat[0] == st.st_size and stat[1] == st.st_mtime:
+            return stat[2]
+
+        h = hashlib.md5()
+        with open(f.path, "rb") as fp:
+            for block in iter(lambda: fp.read(self.blocksize), ""):
+                h.update(block)
+        h = h.hexdigest()
+        stats[f.path] = [st.st_size, st.st_mtime, h]
+        return h
+
+    def names(self):
+        return sorted(self.index["snapshots"].keys())
+
+    def get(self, name):
+        """return {path: blob Filepath} for snapshot name"""
+        snapshot = self.index["snapshots"].get(name, {})
+        return dict((path, self.blob(h)) for path, h in snapshot.items())
+
+    def create(self, name, files, ignore_existing=True):
+        """snapshot files under name
+
+        :param name: string, the snapshot name (eg, "lockdown")
+        :param files: list, Filepath instances, files that don't exist are skipped
+        :param ignore_existing: boolean, if False then a file that is already in
+            the snapshot is left alone
+        :returns: list, the blob Filepath instances of files
+        """
+        snapshot = self.index["snapshots"].setdefault(name, {})
+        blob_fs = []
+        for f in files:
+            if not f.exists(): continue
+
+            if not ignore_existing and f.path in snapshot:
+                blob_fs.append(self.blob(snapshot[f.path]))
+                continue
+
+            h = self.store(f)
+            snapshot[f.path] = h
+            blob_fs.append(self.blob(h))
+
+        self.save_index()
+        return blob_fs
+
+    def add(self, name, f, source_f):
+        """snapshot source_f's contents as f under name, this is how backups kept
+        somewhere else are brought into the store
+
+        :returns: Filepath, the blob of source_f
+        """
+        snapshot = self.index["snapshots"].setdefault(name, {})
+        h = self.store(source_f)
+        snapshot[f.path] = h
+        self.save_index()
+        return self.blob(h)
+
+    def store(self, f):
+        """copy f's contents into the blobs directory if they aren't there yet
+
+        :returns: string, the hash of f's contents
+        """
+        h = self.hash(f)
+        blob_f = self.blob(h)
+        if not blob_f.exists():
+            self.blobs_d.create()
+            fd, tmp_path = tempfile.mkstemp(dir=self.blobs_d.path)
+            os.close(fd)
+            shutil.copy2(f.path, tmp_path)
+            os.rename(tmp_path, blob_f.path)
+        return h
+
+    def restore(self, name, files=None):
+        """copy the files in snapshot name back to where they came from
+
+        :param files: list, only restore these Filepath instances
+        """
+        paths = set(f.path for f in files) if files else None
+        for path, blob_f in self.get(name).items():
+            if paths is not None and path not in paths: continue
+            if not blob_f.exists(): continue
+
+            f = Filepath(path)
+            if f.exists() and self.blob(self.hash(f)).path == blob_f.path:
+                continue
+
+            blob_f.copy(path)
+
+        self.save_index()
+
+    def clear(self, name=""):
+        """remove snapshot name, or every snapshot if name is empty, and delete any
+        blobs that no snapshot uses anymore"""
+        snapshots = self.index["snapshots"]
+        if name:
+            snapshots.pop(name, None)
+        else:
+            snapshots.clear()
+
+        used = set()
+        for snapshot in snapshots.values():
+            used.update(snapshot.values())
+
+        if self.blobs_d.exists():
+            for blob_f in self.blobs_d.files():
+                if blob_f.name not in used:
+                    blob_f.delete()
+
+        self.save_index()
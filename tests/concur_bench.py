@@ -0,0 +1,319 @@
+"""
+Benchmarks for the concur config parsers, these aren't ran with the tests, run
+them directly:
+
+    $ python -m tests.concur_bench
+
+Every format is measured at each size in its own python process so the peak
+memory numbers don't bleed into each other, the results are compared to the
+baselines in concur_bench.json and any regressions are printed (and the exit
+code is non-zero). To update the baselines:
+
+    $ python -m tests.concur_bench --save
+
+There are also a couple of focused benchmarks:
+
+    $ python -m tests.concur_bench insert
+    $ python -m tests.concur_bench continuation
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+import tempfile
+
+import testdata
+
+from stockton.concur.formats import generic, postfix, spamassassin, opendkim
+
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "concur_bench.json")
+
+SIZES = [100, 1000, 10000, 100000, 1000000]
+
+UPDATES = 100
+"""how many options each update benchmark changes"""
+
+
+def generate_main(size):
+    """main.cf, every 10th option has a value that continues over a few lines"""
+    lines = []
+    i = 0
+    while len(lines) < size:
+        if i % 10 == 0:
+            lines.append("option_{} = hash:/etc/postfix/option_{}_0,".format(i, i))
+            lines.extend("    hash:/etc/postfix/option_{}_{},".format(i, j) for j in range(1, 5))
+        elif i % 10 == 5:
+            lines.append("# option_{} is the same as option_{}".format(i, i - 1))
+        else:
+            lines.append("option_{} = $myhostname {}".format(i, i))
+        i += 1
+    return lines[:size]
+
+
+def update_main(c, size):
+    for i in range(UPDATES):
+        c["option_{}".format(i * 10 + 1)] = "updated {}".format(i)
+    c.update(*[("new_option_{}".format(i), i) for i in range(UPDATES)])
+
+
+def generate_master(size):
+    """master.cf, a lot of per-port smtpd services with a few overrides each"""
+    lines = []
+    i = 0
+    while len(lines) < size:
+        lines.append("{}      inet  n       -       -       -       -       smtpd".format(10000 + i))
+        lines.append("  -o syslog_name=postfix/{}".format(10000 + i))
+        lines.append("  -o smtpd_tls_security_level=may")
+        lines.append("  -o smtpd_sasl_auth_enable=yes")
+        lines.append("  -o milter_macro_daemon_name=ORIGINATING")
+        i += 1
+    return lines[:size]
+
+
+def update_master(c, size):
+    for section in c.find_command("smtpd")[:UPDATES]:
+        section.chroot = "n"
+        section["smtpd_tls_security_level"] = "encrypt"
+        section.update(("content_filter", "spamassassin"))
+
+
+def generate_local(size):
+    """local.cf, mostly score lines with some rules and settings mixed in"""
+    lines = ["required_score 5.0", "use_bayes 1", "bayes_auto_learn 1"]
+    i = 0
+    while len(lines) < size:
+        if i % 10 == 0:
+            lines.append("header RULE_{} Subject =~ /rule {}/".format(i, i))
+            lines.append("describe RULE_{} subject contains rule {}".format(i, i))
+        lines.append("score RULE_{} {}.{}".format(i, i % 5, i % 10))
+        i += 1
+    return lines[:size]
+
+
+def update_local(c, size):
+    for i in range(UPDATES):
+        c["score RULE_{}".format(i)] = "0.0"
+    c.update(*[("score NEW_RULE_{}".format(i), "1.0") for i in range(UPDATES)])
+
+
+def generate_opendkim(size):
+    """opendkim.conf"""
+    lines = []
+    i = 0
+    while len(lines) < size:
+        if i % 10 == 0:
+            lines.append("# setting {}".format(i))
+        lines.append("Setting{} value{}".format(i, i))
+        i += 1
+    return lines[:size]
+
+
+def update_opendkim(c, size):
+    for i in range(UPDATES):
+        c["Setting{}".format(i)] = "updated{}".format(i)
+    c.update(*[("NewSetting{}".format(i), i) for i in range(UPDATES)])
+
+
+def generate_alias(size):
+    """a virtual alias file like the ones Postfix.add_domain writes"""
+    return [
+        "user{}@domain{}.com  user{}@example.com".format(i, i % 1000, i) for i in range(size)
+    ]
+
+
+def update_alias(c, size):
+    for i in range(UPDATES):
+        c["user{}@domain{}.com".format(i, i % 1000)] = "updated{}@example.com".format(i)
+    c.update(*[("new{}@example.com".format(i), "user@example.com") for i in range(UPDATES)])
+
+
+FORMATS = {
+    "main": (postfix.Main, generate_main, update_main),
+    "master": (postfix.Master, generate_master, update_master),
+    "local": (spamassassin.Local, generate_local, update_local),
+    "opendkim": (opendkim.OpenDKIM, generate_opendkim, update_opendkim),
+    "alias": (generic.SpaceConfig, generate_alias, update_alias),
+}
+
+
+def measure(name, size):
+    """parse, update, and save a generated config of size lines
+
+    this should be ran in its own process (see run()) so the memory number is
+    only for this config
+
+    :returns: dict, seconds for parse, update and save, and the peak memory in kb
+    """
+    config_class, generate, update = FORMATS[name]
+
+    path = testdata.create_file("{}.conf".format(name), generate(size))
+    dest_path = os.path.join(tempfile.mkdtemp(), "{}.conf".format(name))
+
+    start = time.time()
+    c = config_class(prototype_path=path, dest_path=dest_path)
+    parse = time.time() - start
+
+    start = time.time()
+    update(c, size)
+    update_time = time.time() - start
+
+    start = time.time()
+    c.save()
+    save = time.time() - start
+
+    return {
+        "parse": parse,
+        "update": update_time,
+        "save": save,
+        "memory": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def run(names, sizes):
+    """measure every format in names at every size, each one in a new process
+
+    :returns: dict, {name: {size: measure()}}
+    """
+    results = {}
+    for name in names:
+        results[name] = {}
+        for size in sizes:
+            output = subprocess.check_output([
+                sys.executable,
+                "-m",
+                "tests.concur_bench",
+                "measure",
+                name,
+                str(size),
+            ])
+            results[name][str(size)] = json.loads(output)
+            print("{:<10}{:>10} lines: parse {parse:.3f}s, update {update:.3f}s, save {save:.3f}s, {memory}kb".format(
+                name,
+                size,
+                **results[name][str(size)]
+            ))
+
+    return results
+
+
+def compare(results, baselines, tolerance=0.25):
+    """find the measurements that are more than tolerance worse than the baseline,
+    times that are still under a hundredth of a second are ignored since they are
+    mostly noise
+
+    :returns: list, descriptions of every regression
+    """
+    regressions = []
+    for name, sizes in results.items():
+        for size, result in sizes.items():
+            baseline = baselines.get(name, {}).get(size)
+            if not baseline: continue
+
+            for k, v in result.items():
+                b = baseline.get(k)
+                if b is None: continue
+                if k != "memory" and v < 0.01: continue
+
+                if v > b * (1.0 + tolerance):
+                    regressions.append("{} {} {}: {} is more than {:.0%} over the baseline {}".format(
+                        name,
+                        size,
+                        k,
+                        v,
+                        tolerance,
+                        b
+                    ))
+
+    return regressions
+
+
+def bench_insert(count=10000, size=1000):
+    """insert count new options into the middle of a size line config
+
+    :returns: float, how many seconds the inserts took
+    """
+    path = testdata.create_file("insert.conf", [
+        "option_{} = {}".format(i, i) for i in range(size)
+    ])
+    c = generic.EqualConfig(prototype_path=path)
+    before = "option_{}".format(size // 2)
+
+    start = time.time()
+    for i in range(count):
+        c.update_before(before, ("new_option_{}".format(i), i))
+    return time.time() - start
+
+
+def bench_continuation(count=5000):
+    """parse a main.cf whose virtual_alias_maps continues over count lines
+
+    :returns: float, how many seconds the parse took
+    """
+    lines = ["myhostname = example.com", "virtual_alias_maps ="]
+    lines.extend(
+        "    hash:/etc/postfix/virtual/domain{}.com,".format(i) for i in range(count)
+    )
+    lines.append("smtpd_banner = $myhostname ESMTP")
+    path = testdata.create_file("main.cf", lines)
+
+    start = time.time()
+    c = postfix.Main(prototype_path=path)
+    stop = time.time() - start
+    assert len(c["virtual_alias_maps"].val.splitlines()) == count + 1
+    return stop
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the concur config parsers")
+    parser.add_argument("command", nargs="?", default="suite", choices=[
+        "suite",
+        "measure",
+        "insert",
+        "continuation",
+    ])
+    parser.add_argument("args", nargs="*")
+    parser.add_argument("--formats", nargs="+", default=sorted(FORMATS.keys()), choices=sorted(FORMATS.keys()))
+    parser.add_argument("--sizes", nargs="+", type=int, default=SIZES)
+    parser.add_argument("--save", action="store_true", help="save the results as the new baselines")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    if args.command == "measure":
+        print(json.dumps(measure(args.args[0], int(args.args[1]))))
+
+    elif args.command == "insert":
+        print("insert 10k options: {:.3f}s".format(bench_insert()))
+
+    elif args.command == "continuation":
+        print("virtual_alias_maps with 5k domains: {:.3f}s".format(bench_continuation()))
+
+    else:
+        results = run(args.formats, args.sizes)
+
+        baselines = {}
+        if os.path.isfile(BASELINE_PATH):
+            with open(BASELINE_PATH) as fp:
+                baselines = json.load(fp)
+
+        if args.save:
+            for name, sizes in results.items():
+                baselines.setdefault(name, {}).update(sizes)
+            with open(BASELINE_PATH, "w") as fp:
+                json.dump(baselines, fp, indent=2, sort_keys=True)
+                fp.write("\n")
+
+        else:
+            regressions = compare(results, baselines, args.tolerance)
+            for regression in regressions:
+                print("REGRESSION {}".format(regression))
+            return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,12 +1,16 @@
 from unittest import TestCase
 import re
+import os
+import difflib
 
 import testdata
 
-from stockton.concur.formats.base import ConfigFile, Config, ConfigSection
+from stockton.concur.formats.base import ConfigFile, Config, ConfigSection, ConfigLines, MmapConfigFile, NameMatcher
 from stockton.concur.formats import postfix
 from stockton.concur.formats import generic
 from stockton.concur.formats import spamassassin
+from stockton.concur.cache import ConfigCache
+from stockton.concur.loader import load, load_threads
 
 
 def setUpModule():
@@ -58,7 +62,205 @@ def tearDownModule():
 #             fp.next()
 
 
+class ConfigFileTest(TestCase):
+    def test_window(self):
+        path = testdata.create_file("counting.conf", ["#{}".format(x) for x in range(100)])
+
+        fp = ConfigFile(path, Config())
+        fp.window = 4
+
+        c = fp.next()
+        self.assertEqual("#0", c.line)
+        self.assertEqual("#1", fp.peek())
+        self.assertEqual(0, fp.line_number)
+
+        for x in range(1, 50):
+            c = fp.next()
+            self.assertEqual("#{}".format(x), c.line)
+            self.assertTrue(len(fp.buffer) <= fp.window + 2)
+
+        fp.rewind(47)
+        self.assertEqual("#48", fp.next().line)
+        self.assertEqual("#49", fp.next().line)
+
+        with self.assertRaises(ValueError):
+            fp.rewind(10)
+
+        lines = [c.line for c in fp]
+        self.assertEqual(50, len(lines))
+        self.assertEqual("#99", lines[-1])
+        self.assertEqual(None, fp.peek())
+        self.assertTrue(fp.fp.closed)
+
+    def test_mmap(self):
+        class MmapConfig(generic.SpaceConfig):
+            file_class = MmapConfigFile
+            cache = None
+
+        path = testdata.create_file("mmap.conf", "\r\n".join(
+            ["# aliases"] + ["user{} user{}@example.com".format(x, x) for x in range(50)]
+        ))
+        dest_path = os.path.join(os.path.dirname(path), "mmap_dest.conf")
+
+        c = MmapConfig(prototype_path=path, dest_path=dest_path)
+        self.assertEqual(51, len(c.lines))
+        self.assertEqual("user10@example.com", c["user10"].val)
+        self.assertEqual((0, 11), c.lines[0].span)
+
+        c["user10"] = "foo@example.com"
+        del c["user20"]
+        c.update(("user50", "user50@example.com"))
+        self.assertTrue(c.save())
+
+        with open(dest_path, "rb") as fp:
+            body = fp.read()
+
+        self.assertTrue("user9 user9@example.com\r\n" in body)
+        # rendered lines get the same endings as the lines around them
+        self.assertTrue("user10                  foo@example.com\r\n" in body)
+        self.assertFalse("user20 " in body)
+        self.assertTrue(body.endswith("user49 user49@example.com\r\nuser50                  user50@example.com\r\n"))
+        self.assertFalse(c.save())
+
+        fp = MmapConfigFile(path, c)
+        self.assertEqual(51, len(list(fp)))
+        fp.close()
+        self.assertEqual(None, fp.fp)
+        self.assertEqual(path, fp.source)
+
+        # the file was changed in place after it was parsed, so the spans don't
+        # point at the right bytes anymore and the config is rendered instead
+        c = MmapConfig(prototype_path=path, dest_path=dest_path)
+        with open(path, "r+b") as fp:
+            fp.truncate(20)
+        c["user10"] = "bar@example.com"
+        self.assertTrue(c.save())
+        with open(dest_path, "rb") as fp:
+            body = fp.read()
+        self.assertTrue("user9 user9@example.com\n" in body)
+        self.assertTrue("user10                  bar@example.com\n" in body)
+
+        path = testdata.create_file("mmap_empty.conf", "")
+        c = MmapConfig(prototype_path=path)
+        self.assertEqual(0, len(c.lines))
+
+
+class LoaderTest(TestCase):
+    def test_load(self):
+        main_path = testdata.create_file("main.cf", [
+            "myhostname = example.com",
+            "virtual_alias_maps = hash:/etc/postfix/one,",
+            "    hash:/etc/postfix/two",
+        ])
+        master_path = testdata.create_file("master.cf", [
+            "smtp      inet  n       -       -       -       -       smtpd",
+            "  -o smtpd_tls_security_level=may",
+        ])
+        specs = {
+            "main": (postfix.Main, main_path),
+            "master": (postfix.Master, master_path, "/tmp/master.cf"),
+        }
+
+        for configs in [load(specs), load_threads(specs)]:
+            self.assertEqual("example.com", configs["main"]["myhostname"].val)
+            self.assertEqual(main_path, configs["main"].prototype_path)
+            self.assertEqual("/tmp/master.cf", configs["master"].dest_path)
+
+            smtp = configs["master"].find_service("smtp", "inet")
+            smtp["smtpd_tls_security_level"] = "encrypt"
+            self.assertTrue("encrypt" in str(configs["master"]))
+            self.assertTrue(smtp.config is configs["master"])
+
+        self.assertEqual({}, load({}))
+
+
+class ConfigLinesTest(TestCase):
+    def test_insert(self):
+        lines = ConfigLines()
+        lines.gap = 4
+        expected = []
+        for x in range(10):
+            o = object()
+            lines.append(o)
+            expected.append(o)
+
+        # keep inserting into the same spot so the gaps run out
+        for x in range(50):
+            o = object()
+            lines.insert(5, o)
+            expected.insert(5, o)
+
+        o = object()
+        lines.insert(0, o)
+        expected.insert(0, o)
+
+        self.assertEqual(expected, list(lines))
+        for i, o in enumerate(expected):
+            self.assertEqual(i, lines.index(o))
+
+        lines.remove(expected[7])
+        expected.pop(7)
+        self.assertEqual(expected, list(lines))
+        self.assertEqual(7, lines.index(expected[7]))
+
+
+class ConfigCacheTest(TestCase):
+    def test_load(self):
+        contents = [
+            "smtp      inet  n       -       -       -       -       smtpd",
+            "  -o foo=yes",
+            "pickup    unix  n       -       -       60      1       pickup",
+        ]
+        path = testdata.create_file("master.cf", contents)
+        cache = ConfigCache(directory=testdata.create_dir())
+
+        postfix.Master.cache = cache
+        try:
+            m = postfix.Master(prototype_path=path)
+            self.assertEqual(1, len(cache.entries))
+
+            m2 = postfix.Master(prototype_path=path)
+            self.assertEqual(str(m), str(m2))
+            self.assertTrue(m2["smtp"].config is m2)
+            self.assertFalse(m2["smtp"] is m["smtp"])
+            self.assertEqual(1, m2.lines.index(m2["pickup"]))
+
+            m2["smtp"]["foo"] = "no"
+            self.assertEqual("yes", m["smtp"]["foo"].val)
+
+            # the on-disk layer should still have it
+            cache.clear()
+            m3 = postfix.Master(prototype_path=path)
+            self.assertEqual(str(m), str(m3))
+
+            # a changed file shouldn't use the cached version
+            contents[1] = "  -o foo=maybe"
+            path = testdata.create_file("master.cf", contents)
+            m4 = postfix.Master(prototype_path=path)
+            self.assertEqual("maybe", m4["smtp"]["foo"].val)
+
+        finally:
+            del postfix.Master.cache
+
+
 class SpaceTest(TestCase):
+    def test_write_options(self):
+        d = testdata.create_dir()
+        options = [
+            ("@example.com", "catchall@example.com"),
+            ("a_really_long_address_name@example.com", "foo@example.com"),
+            ("bar@example.com", 5),
+        ]
+
+        c = generic.SpaceConfig(dest_path=os.path.join(d, "config"))
+        c.update(*options)
+        c.save()
+
+        path = os.path.join(d, "stream")
+        count = generic.SpaceConfig.write_options(path, iter(options))
+        self.assertEqual(3, count)
+        self.assertEqual(open(c.dest_path).read(), open(path).read())
+
     def test_multi_word_name(self):
         """There are certain cases where you can have a certain keyword multiple times
 
@@ -160,6 +362,50 @@ class PostfixTest(TestCase):
         self.assertEqual("rab", c2["foo"].val)
         self.assertEqual("baz", c2["che"].val)
 
+    def test_master_update_lines(self):
+        path = testdata.create_file("master.cf", [
+            "smtp      inet  n       -       -       -       -       smtpd",
+        ])
+        m = postfix.Master(prototype_path=path)
+        section = m.create_section("spamassassin unix - n n - - pipe")
+        changes = section.update(
+            "user=debian-spamd argv=/usr/bin/spamc -f -e",
+            "/usr/sbin/sendmail -oi -f ${sender} ${recipient}"
+        )
+        self.assertEqual([], changes)
+        m["spamassassin"] = section
+        self.assertEqual(2, len(m["spamassassin"].lines))
+        self.assertTrue("  user=debian-spamd argv=/usr/bin/spamc -f -e" in str(m))
+
+    def test_main_save(self):
+        contents = "\n".join([
+            "foo = bar",
+            "che = baz",
+        ]) + "\n"
+        path = testdata.create_file("main.cf", contents)
+        os.chmod(path, 0o640)
+        mtime = os.path.getmtime(path)
+        inode = os.stat(path).st_ino
+
+        c = postfix.Main(dest_path=path, prototype_path=path)
+        self.assertFalse(c.save())
+        self.assertEqual(inode, os.stat(path).st_ino)
+        self.assertEqual(mtime, os.path.getmtime(path))
+
+        c["foo"] = "rab"
+        self.assertTrue(c.save())
+        self.assertNotEqual(inode, os.stat(path).st_ino)
+        self.assertEqual(0o640, os.stat(path).st_mode & 0o777)
+        with open(path) as fp:
+            self.assertEqual("foo = rab\nche = baz\n", fp.read())
+        self.assertFalse(c.save())
+
+        # saving to a brand new file
+        path = os.path.join(testdata.create_dir(), "new.cf")
+        c.dest_path = path
+        self.assertTrue(c.save())
+        self.assertTrue(os.path.isfile(path))
+
     def test_main_oneline(self):
         contents = "\n".join([
             "virtual_alias_map = hash:/some/path/one",
@@ -200,6 +446,122 @@ class PostfixTest(TestCase):
         ])
         self.assertEqual(contents, str(c))
 
+    def test_main_long_multiline(self):
+        lines = ["virtual_alias_maps ="]
+        lines.extend("  hash:/some/path/{},".format(i) for i in range(100))
+        lines.extend("option_{} = {}".format(i, i) for i in range(2000))
+        contents = "\n".join(lines)
+        path = testdata.create_file("main.cf", contents)
+        c = postfix.Main(prototype_path=path)
+        self.assertEqual(2001, len(c.lines))
+        self.assertEqual(101, len(c["virtual_alias_maps"].val.splitlines()))
+        self.assertEqual(contents, str(c))
+
+    def test_main_lazy(self):
+        contents = "\n".join([
+            "myhostname = mail.example.com # the hostname",
+            "virtual_alias_map = hash:/some/path/one,",
+            "  hash:/some/path/two",
+            "#foo = bar",
+        ])
+        path = testdata.create_file("main.cf", contents)
+        c = postfix.Main(prototype_path=path)
+        for cl in c:
+            if isinstance(cl, postfix.MainOption):
+                self.assertTrue(isinstance(cl._offset, int))
+                self.assertEqual(None, cl._val)
+                self.assertEqual(None, cl._comment)
+
+        self.assertEqual(contents, str(c))
+
+        self.assertEqual("mail.example.com", c["myhostname"].val)
+        self.assertEqual("the hostname", c["myhostname"].comment)
+        self.assertEqual(
+            "hash:/some/path/one,\n  hash:/some/path/two",
+            c["virtual_alias_map"].val
+        )
+        self.assertEqual("bar", c["foo"].val)
+        self.assertEqual(contents, str(c))
+
+        # reading the val doesn't keep a copy of it
+        self.assertEqual(None, c["foo"]._val)
+        self.assertTrue(c["foo"].name is intern("foo"))
+
+        c["myhostname"] = "mail2.example.com"
+        self.assertEqual(
+            "myhostname = mail2.example.com # the hostname",
+            str(c["myhostname"])
+        )
+
+    def test_main_lazy_modified(self):
+        path = testdata.create_file("main.cf", ["foo = bar # c1"])
+
+        c = postfix.Main(prototype_path=path)
+        c["foo"].comment = "new"
+        self.assertEqual("foo = bar # new", str(c))
+
+        c = postfix.Main(prototype_path=path)
+        c["foo"].name = "che"
+        self.assertEqual("che = bar # c1", str(c))
+
+        c = postfix.Main(prototype_path=path)
+        c["foo"].modified = True
+        self.assertEqual("foo = bar # c1", str(c))
+
+        # a val that is an int is never mistaken for where the val starts
+        c = postfix.Main(prototype_path=path)
+        c["foo"] = 5
+        self.assertEqual(5, c["foo"].val)
+        self.assertEqual("foo = 5 # c1", str(c))
+
+        c = postfix.Main(prototype_path=path)
+        c["foo"].val = None
+        self.assertEqual(None, c["foo"].val)
+
+        # lazy is only on for the configs that ask for it
+        self.assertFalse(generic.EqualConfig.lazy)
+
+    def test_main_resolve(self):
+        contents = "\n".join([
+            "#data_directory = /tmp",
+            "data_directory = /var/lib/postfix",
+            "cache_directory = $data_directory/cache",
+            "smtpd_tls_session_cache_database = btree:${cache_directory}/smtpd_scache",
+            "smtp_tls_session_cache_database = btree:$(cache_directory)/smtp_scache",
+            "myhostname = $mydomain",
+            "loop_one = $loop_two",
+            "loop_two = ${loop_one}",
+        ])
+        path = testdata.create_file("main.cf", contents)
+        c = postfix.Main(prototype_path=path)
+
+        self.assertEqual(
+            "btree:/var/lib/postfix/cache/smtpd_scache",
+            c.resolve("smtpd_tls_session_cache_database")
+        )
+        self.assertEqual(
+            "btree:/var/lib/postfix/cache/smtp_scache",
+            c.resolve("smtp_tls_session_cache_database")
+        )
+        self.assertEqual("$mydomain", c.resolve("myhostname"))
+        self.assertIsNone(c.resolve("mydomain"))
+        self.assertEqual("/var/lib/postfix/x", c.expand("${data_directory}/x"))
+        with self.assertRaises(ValueError):
+            c.resolve("loop_one")
+
+        c["data_directory"] = "/srv/postfix"
+        self.assertFalse("cache_directory" in c.expanded)
+        self.assertEqual(
+            "btree:/srv/postfix/cache/smtpd_scache",
+            c.resolve("smtpd_tls_session_cache_database")
+        )
+
+        c["mydomain"] = "example.com"
+        self.assertEqual("example.com", c.resolve("myhostname"))
+
+        del c["mydomain"]
+        self.assertEqual("$mydomain", c.resolve("myhostname"))
+
     def test_master_multiple_same_name(self):
         contents = "\n".join([
             "smtp      inet  n       -       -       -       -       smtpd",
@@ -219,6 +581,75 @@ class PostfixTest(TestCase):
         ])
         self.assertEqual(contents, str(master))
 
+    def test_master_services(self):
+        contents = "\n".join([
+            "smtp      inet  n       -       -       -       -       smtpd",
+            "  -o smtpd_tls_security_level=may",
+            "2525      inet  n       -       -       -       -       smtpd",
+            "smtp      unix  -       -       -       -       -       smtp",
+        ])
+        master_path = testdata.create_file("master.cf", contents)
+        master = postfix.Master(prototype_path=master_path)
+
+        self.assertEqual("smtpd", master.find_service("smtp", "inet").cmd)
+        self.assertEqual("smtp", master.find_service("smtp", "unix").cmd)
+        self.assertIsNone(master.find_service("smtp", "fifo"))
+        self.assertEqual(2, len(master.find_command("smtpd")))
+        self.assertEqual(1, len(master.find_command("smtpd", "smtp")))
+        self.assertEqual(1, len(master.find_service("smtp", "inet").lines))
+
+        master.find_service("2525", "inet").cmd = "postscreen"
+        self.assertEqual(1, len(master.find_command("smtpd")))
+        self.assertEqual("2525", master.find_command("postscreen")[0].name)
+
+        section = master.create_section("submission inet n - - - - smtpd")
+        master["submission"] = section
+        self.assertEqual(2, len(master.find_command("smtpd")))
+
+        master.remove(master.find_service("smtp", "unix"))
+        self.assertIsNone(master.find_service("smtp", "unix"))
+
+    def test_master_str_cache(self):
+        contents = "\n".join([
+            "smtp      inet  n       -       -       -       -       smtpd",
+            "  -o smtpd_tls_security_level=may",
+            "2525      inet  n       -       -       -       -       smtpd",
+            "  -o smtpd_tls_security_level=may",
+        ])
+        master_path = testdata.create_file("master.cf", contents)
+        master = postfix.Master(prototype_path=master_path)
+        self.assertEqual(contents, str(master))
+
+        smtp = master.find_service("smtp", "inet")
+        other = master.find_service("2525", "inet")
+        self.assertEqual(contents, master._str)
+        self.assertIsNotNone(smtp._str)
+
+        smtp["smtpd_tls_security_level"] = "encrypt"
+        self.assertIsNone(smtp._str)
+        self.assertIsNone(master._str)
+        self.assertIsNotNone(other._str)
+        self.assertTrue("encrypt" in str(master))
+
+        smtp.update(("smtpd_sasl_auth_enable", "yes"))
+        self.assertTrue("smtpd_sasl_auth_enable" in str(master))
+
+        master.remove(other)
+        self.assertFalse("2525" in str(master))
+
+    def test_classify(self):
+        m = postfix.Main()
+        self.assertEqual(postfix.MainOption, m.classify("foo = bar"))
+        self.assertEqual(postfix.MainOption, m.classify("#foo = bar"))
+        self.assertEqual(m.line_class, m.classify("# some comment"))
+        self.assertEqual(m.line_class, m.classify("  hash:/some/path/two"))
+
+        m = postfix.Master()
+        self.assertEqual(postfix.MasterSection, m.classify("smtp inet n - - - - smtpd"))
+        self.assertEqual(postfix.MasterSection, m.classify("#smtp inet n - - - - smtpd"))
+        self.assertEqual(postfix.MasterOption, m.classify("  -o foo=yes"))
+        self.assertEqual(postfix.MasterLine, m.classify("# service type  private unpriv"))
+
     def test_master_option(self):
         master = postfix.Master()
         class FP(object):
@@ -350,6 +781,421 @@ class PostfixTest(TestCase):
 
 
 class ConfigTest(TestCase):
+    def test_grammar(self):
+        class FooConfig(generic.SpaceConfig):
+            option_name_regexes = [
+                "^foo\s+[A-Z0-9_]+"
+            ]
+
+        self.assertFalse(FooConfig.grammar is generic.SpaceConfig.grammar)
+        self.assertEqual(1, len(FooConfig.grammar.option_name_regexes))
+        self.assertEqual(0, len(generic.SpaceConfig.grammar.option_name_regexes))
+
+        self.assertEqual(
+            ("foo NAME", "VALUE", "comment"),
+            FooConfig.grammar.tokenize("foo NAME VALUE # comment")
+        )
+        self.assertEqual(
+            ("foo", "bar", ""),
+            postfix.Main.grammar.tokenize("#foo = bar")
+        )
+
+    def test_diff(self):
+        path = testdata.create_file(
+            "diff.conf",
+            "".join("option_{} = {}\n".format(i, i) for i in range(20))
+        )
+        c = generic.EqualConfig(prototype_path=path, dest_path="/tmp/diff.conf")
+        self.assertEqual("", c.diff())
+
+        c["option_2"] = "two"
+        del c["option_10"]
+        c.update_before("option_15", ("new_option", "new"))
+        c.update(("last_option", "last"))
+        patch = c.diff()
+        self.assertTrue(patch.startswith("--- {}\n+++ /tmp/diff.conf\n@@ -1,6 +1,6 @@\n".format(path)))
+        self.assertTrue("-option_2 = 2\n+option_2 = two\n" in patch)
+        self.assertTrue("-option_10 = 10\n" in patch)
+        self.assertTrue(" option_14 = 14\n+new_option = new\n option_15 = 15\n" in patch)
+        self.assertTrue(" option_19 = 19\n+last_option = last\n" in patch)
+
+        # the diff should be the same as diffing the whole files
+        expected = "".join(difflib.unified_diff(
+            open(path).read().splitlines(True),
+            "{}\n".format(c).splitlines(True),
+            path,
+            "/tmp/diff.conf",
+        ))
+        self.assertEqual(expected, patch)
+
+        c2 = generic.EqualConfig(prototype_path=path)
+        c2.apply(patch)
+        self.assertEqual(str(c), str(c2))
+        self.assertEqual("two", c2["option_2"].val)
+        self.assertEqual("", c2.diff())
+
+        with self.assertRaises(ValueError):
+            c2.apply(patch)
+
+        # a blank last line survives the round trip
+        path = testdata.create_file("main.cf", "myhostname = a\n")
+        c = postfix.Main(prototype_path=path)
+        c.update(("biff", "no"), "")
+        self.assertEqual("myhostname = a\nbiff = no\n", str(c))
+        c2 = postfix.Main(prototype_path=path)
+        c2.apply(c.diff())
+        self.assertEqual(str(c), str(c2))
+        self.assertEqual("", c2.diff())
+        self.assertEqual(3, len(c2.lines))
+
+    def test_diff_master(self):
+        contents = [
+            "smtp      inet  n       -       -       -       -       smtpd",
+            "  -o smtpd_tls_security_level=may",
+            "2525      inet  n       -       -       -       -       smtpd",
+        ]
+        path = testdata.create_file("master.cf", contents)
+        m = postfix.Master(prototype_path=path)
+        m.find_service("smtp", "inet")["smtpd_tls_security_level"] = "encrypt"
+        patch = m.diff(n=0)
+        self.assertTrue(patch.endswith("@@ -2 +2 @@\n-  -o smtpd_tls_security_level=may\n+  -o smtpd_tls_security_level=encrypt\n"))
+
+        m2 = postfix.Master(prototype_path=path)
+        m2.apply(patch)
+        self.assertEqual(str(m), str(m2))
+
+    def test_diff_save_master(self):
+        path = testdata.create_file("master.cf", "\n".join([
+            "#",
+            "# Postfix master process configuration file.",
+            "#",
+            "# ==========================================================================",
+            "# service type  private unpriv  chroot  wakeup  maxproc command + args",
+            "# ==========================================================================",
+            "smtp      inet  n       -       y       -       -       smtpd",
+            "#  -o smtpd_sasl_auth_enable=yes",
+            "pickup    unix  n       -       y       60      1       pickup",
+        ]) + "\n")
+        m = postfix.Master(prototype_path=path, dest_path=path)
+        self.assertEqual("", m.diff())
+        self.assertFalse(m.save())
+
+    def test_fork(self):
+        path = testdata.create_file("fork.cf", [
+            "myhostname = example.com",
+            "smtpd_helo_required = no",
+            "disable_vrfy_command = no",
+        ])
+        m = postfix.Main(prototype_path=path)
+        original = str(m)
+
+        lockdown = m.fork()
+        relaxed = m.fork()
+        lockdown["smtpd_helo_required"] = "yes"
+        lockdown.update(("strict_rfc821_envelopes", "yes"))
+        relaxed["disable_vrfy_command"] = "yes"
+        del relaxed["myhostname"]
+
+        self.assertEqual(original, str(m))
+        self.assertEqual("", m.diff())
+        self.assertEqual("no", m["smtpd_helo_required"].val)
+        self.assertEqual("yes", lockdown["smtpd_helo_required"].val)
+        self.assertEqual("no", relaxed["smtpd_helo_required"].val)
+        self.assertFalse("strict_rfc821_envelopes" in relaxed)
+        self.assertTrue("myhostname" in lockdown)
+
+        # the lines nobody looked up are still shared
+        self.assertIs(m.lines[0], lockdown.lines[0])
+        self.assertIsNot(m.lines[1], lockdown.lines[1])
+        self.assertIs(m.lines[2], lockdown.lines[2])
+
+        patch = lockdown.diff(n=0)
+        self.assertTrue("-smtpd_helo_required = no\n+smtpd_helo_required = yes\n" in patch)
+        self.assertTrue("+strict_rfc821_envelopes = yes\n" in patch)
+        self.assertFalse("disable_vrfy_command" in patch)
+
+        # the parent modifying a shared line doesn't touch its forks
+        m["myhostname"] = "example.org"
+        self.assertEqual("example.com", lockdown["myhostname"].val)
+        self.assertEqual("myhostname = example.com", str(lockdown).split("\n")[0])
+
+        m2 = postfix.Main(prototype_path=path)
+        m2.apply(relaxed.diff())
+        self.assertEqual(str(relaxed), str(m2))
+
+        # a fork rebuilding its lines doesn't take over the lines it still shares
+        f = m.fork()
+        f.update_before("smtpd_helo_required", *[("option_{}".format(i), i) for i in range(10)])
+        self.assertIs(m.lines[2], f.lines[12])
+        self.assertIs(m, m.lines[2].parent)
+        self.assertTrue(m.lines[2] in f.shared)
+
+        path = testdata.create_file("master.cf", [
+            "smtp      inet  n       -       -       -       -       smtpd",
+            "  -o smtpd_tls_security_level=may",
+        ])
+        m = postfix.Master(prototype_path=path)
+        f = m.fork()
+        f.find_service("smtp", "inet")["smtpd_tls_security_level"] = "encrypt"
+        self.assertEqual("may", m.find_service("smtp", "inet")["smtpd_tls_security_level"].val)
+        self.assertTrue("-o smtpd_tls_security_level=encrypt" in str(f))
+        self.assertTrue("+  -o smtpd_tls_security_level=encrypt" in f.diff())
+
+    def test_effective(self):
+        main_path = testdata.create_file("main.cf", [
+            "myhostname = example.com",
+            "smtpd_tls_security_level = may",
+            "smtpd_banner = $myhostname ESMTP",
+        ])
+        master_path = testdata.create_file("master.cf", [
+            "smtp      inet  n       -       -       -       -       smtpd",
+            "submission inet n       -       -       -       -       smtpd",
+            "  -o smtpd_tls_security_level=encrypt",
+            "  -o smtpd_banner=$myhostname submission",
+            "#  -o smtpd_sasl_auth_enable=yes",
+            "#smtps     inet  n       -       -       -       -       smtpd",
+            "#  -o smtpd_tls_wrappermode=yes",
+        ])
+        m = postfix.Main(prototype_path=main_path)
+        ms = postfix.Master(prototype_path=master_path)
+        e = postfix.EffectiveConfig(m, ms)
+
+        self.assertEqual("may", e.get("smtpd_tls_security_level"))
+        self.assertEqual("may", e.get("smtpd_tls_security_level", "smtp"))
+        self.assertEqual("encrypt", e.get("smtpd_tls_security_level", "submission"))
+        self.assertEqual("example.com submission", e.get("smtpd_banner", "submission"))
+        self.assertEqual("example.com ESMTP", e.get("smtpd_banner", "smtp"))
+        self.assertIsNone(e.get("smtpd_sasl_auth_enable", "submission"))
+        self.assertEqual("no", e.get("smtpd_sasl_auth_enable", "submission", default="no"))
+        self.assertEqual({}, e.service_overrides("smtps"))
+
+        m["myhostname"] = "example.org"
+        self.assertEqual("example.org submission", e.get("smtpd_banner", "submission"))
+
+        overrides = e.overrides
+        ms.find_service("submission", "inet")["smtpd_tls_security_level"] = "may"
+        ms.find_service("smtp", "inet").update(("smtpd_tls_security_level", "none"))
+        self.assertIs(overrides, e.overrides)
+        self.assertEqual("may", e.get("smtpd_tls_security_level", "submission"))
+        self.assertEqual("none", e.get("smtpd_tls_security_level", "smtp"))
+
+        del ms.find_service("submission", "inet")["smtpd_banner"]
+        self.assertIs(overrides, e.overrides)
+        self.assertEqual("example.org ESMTP", e.get("smtpd_banner", "submission"))
+
+        ms.find_service("smtp", "inet").name = "2525"
+        self.assertEqual("none", e.get("smtpd_tls_security_level", "2525"))
+        self.assertEqual("may", e.get("smtpd_tls_security_level", "smtp"))
+
+        e.close()
+        self.assertEqual([], m.listeners)
+
+    def test_refresh(self):
+        d = testdata.create_dir()
+        contents = [
+            "myhostname = example.com",
+            "# virtual domains",
+            "virtual_alias_maps = hash:/etc/postfix/one,",
+            "    hash:/etc/postfix/two",
+            "smtpd_banner = $myhostname ESMTP",
+            "",
+            "mynetworks = 127.0.0.0/8",
+        ]
+        path = testdata.create_file("main.cf", contents, d)
+        m = postfix.Main(prototype_path=path)
+        self.assertFalse(m.refresh())
+
+        first = m["myhostname"]
+        last = m["mynetworks"]
+        m["mynetworks"] = "10.0.0.0/8"
+        m.update(("new_option", "new"))
+
+        contents[3:4] = ["    hash:/etc/postfix/two,", "    hash:/etc/postfix/three"]
+        contents[5] = "smtpd_banner = $myhostname ESMTP $mail_name"
+        path = testdata.create_file("main.cf", contents, d)
+        self.assertTrue(m.refresh())
+
+        self.assertIs(first, m["myhostname"])
+        self.assertIs(last, m["mynetworks"])
+        self.assertEqual("10.0.0.0/8", m["mynetworks"].val)
+        self.assertEqual("new", m["new_option"].val)
+        self.assertEqual(3, len(m["virtual_alias_maps"].val.splitlines()))
+        self.assertEqual("example.com ESMTP $mail_name", m.resolve("smtpd_banner"))
+
+        m2 = postfix.Main(prototype_path=path)
+        m2["mynetworks"] = "10.0.0.0/8"
+        m2.update(("new_option", "new"))
+        self.assertEqual(str(m2), str(m))
+        self.assertEqual(m2.diff(), m.diff())
+
+        # a region at the front that is now gone
+        path = testdata.create_file("main.cf", contents[2:], d)
+        self.assertTrue(m.refresh())
+        self.assertFalse("myhostname" in m)
+        self.assertIs(last, m["mynetworks"])
+        self.assertEqual("$myhostname ESMTP $mail_name", m.resolve("smtpd_banner"))
+
+        contents = [
+            "smtp      inet  n       -       -       -       -       smtpd",
+            "  -o smtpd_tls_security_level=may",
+            "pickup    unix  n       -       -       60      1       pickup",
+        ]
+        path = testdata.create_file("master.cf", contents, d)
+        ms = postfix.Master(prototype_path=path)
+        pickup = ms.find_service("pickup", "unix")
+
+        contents.insert(2, "  -o smtpd_sasl_auth_enable=yes")
+        path = testdata.create_file("master.cf", contents, d)
+        self.assertTrue(ms.refresh())
+        self.assertIs(pickup, ms.find_service("pickup", "unix"))
+        self.assertEqual("yes", ms.find_service("smtp", "inet")["smtpd_sasl_auth_enable"].val)
+        self.assertEqual(str(postfix.Master(prototype_path=path)), str(ms))
+
+        # a new service owns the -o lines that follow it
+        contents[3:3] = [
+            "submission inet n       -       -       -       -       smtpd",
+            "  -o smtpd_tls_security_level=encrypt",
+            "  -o smtpd_sasl_auth_enable=yes",
+        ]
+        path = testdata.create_file("master.cf", contents, d)
+        self.assertTrue(ms.refresh())
+        self.assertIs(pickup, ms.find_service("pickup", "unix"))
+        submission = ms.find_service("submission", "inet")
+        self.assertEqual(2, len(submission.lines))
+        self.assertEqual("encrypt", submission["smtpd_tls_security_level"].val)
+        self.assertEqual(str(postfix.Master(prototype_path=path)), str(ms))
+        self.assertEqual(3, len(ms.lines))
+
+    def test_refresh_continuation(self):
+        d = testdata.create_dir()
+        contents = [
+            "myhostname = example.com",
+            "# mynetworks is below",
+            "    10.0.0.0/8,",
+            "    172.16.0.0/12,",
+            "    192.168.0.0/16",
+            "biff = no",
+        ]
+        path = testdata.create_file("main.cf", contents, d)
+        m = postfix.Main(prototype_path=path)
+        biff = m["biff"]
+
+        contents[1] = "mynetworks ="
+        path = testdata.create_file("main.cf", contents, d)
+        self.assertTrue(m.refresh())
+        self.assertEqual(
+            "\n    10.0.0.0/8,\n    172.16.0.0/12,\n    192.168.0.0/16",
+            m["mynetworks"].val
+        )
+        self.assertEqual(3, len(m.lines))
+        self.assertIs(biff, m["biff"])
+        self.assertEqual(str(postfix.Main(prototype_path=path)), str(m))
+
+        contents = [
+            "# submission is turned off",
+            "  -o smtpd_tls_security_level=encrypt",
+            "  -o smtpd_sasl_auth_enable=yes",
+            "smtp      inet  n       -       -       -       -       smtpd",
+        ]
+        path = testdata.create_file("master.cf", contents, d)
+        ms = postfix.Master(prototype_path=path)
+        smtp = ms.find_service("smtp", "inet")
+
+        contents[0] = "submission inet n       -       -       -       -       smtpd"
+        path = testdata.create_file("master.cf", contents, d)
+        self.assertTrue(ms.refresh())
+        self.assertEqual(2, len(ms.lines))
+        self.assertEqual(2, len(ms.find_service("submission", "inet").lines))
+        self.assertIs(smtp, ms.find_service("smtp", "inet"))
+        self.assertEqual(str(postfix.Master(prototype_path=path)), str(ms))
+
+    def test_refresh_comment(self):
+        d = testdata.create_dir()
+        contents = []
+        for i in range(100):
+            contents.append("# option_{}".format(i))
+            contents.append("option_{} = {}".format(i, i))
+        path = testdata.create_file("main.cf", contents, d)
+        m = postfix.Main(prototype_path=path)
+        option = m["option_50"]
+
+        contents[100] = "# option_50 is the one in the middle"
+        path = testdata.create_file("main.cf", contents, d)
+        self.assertTrue(m.refresh())
+        self.assertIs(option, m["option_50"])
+        self.assertEqual(contents[100], m.lines[100].line)
+        self.assertEqual(str(postfix.Main(prototype_path=path)), str(m))
+
+    def test_refresh_hunks(self):
+        d = testdata.create_dir()
+        contents = ["biff = no"]
+        for i in range(50):
+            contents.append("# option_{}".format(i))
+            contents.append("option_{} = {}".format(i, i))
+        contents.append("mynetworks = 127.0.0.0/8")
+        for i in range(50, 100):
+            contents.append("option_{} = {}".format(i, i))
+        path = testdata.create_file("main.cf", contents, d)
+        m = postfix.Main(prototype_path=path)
+        mynetworks = m["mynetworks"]
+        m["mynetworks"] = "10.0.0.0/8"
+
+        # two edits far apart, the modified option between them isn't touched
+        contents[0] = "biff = yes"
+        contents.append("appended = 1")
+        path = testdata.create_file("main.cf", contents, d)
+        self.assertTrue(m.refresh())
+        self.assertIs(mynetworks, m["mynetworks"])
+        self.assertEqual("10.0.0.0/8", m["mynetworks"].val)
+        self.assertEqual("yes", m["biff"].val)
+        self.assertEqual("1", m["appended"].val)
+
+        m2 = postfix.Main(prototype_path=path)
+        m2["mynetworks"] = "10.0.0.0/8"
+        self.assertEqual(str(m2), str(m))
+        self.assertEqual(m2.diff(), m.diff())
+
+    def test_name_matcher(self):
+        m = NameMatcher([
+            "^foo\s+[A-Z]+",
+            "^foobar\s+\S+",
+            "^colou?r\s+\S+",
+            "^(?:one|two)\s+\S+",
+            "^foo\s+\S+",
+        ])
+        self.assertEqual(5, len(m))
+        self.assertEqual(1, len(m.fallback))
+        self.assertEqual("colo", m.prefix("^colou?r\s+\S+"))
+
+        # the last pattern that matches wins
+        self.assertEqual("foo bar", m.match("foo bar che").group(0))
+        self.assertEqual("foobar baz", m.match("foobar baz che").group(0))
+        self.assertEqual("color red", m.match("color red").group(0))
+        self.assertEqual("colour red", m.match("colour red").group(0))
+        self.assertEqual("two 2", m.match("two 2").group(0))
+        self.assertIsNone(m.match("three 3"))
+        self.assertIsNone(m.match(""))
+
+    def test_slots(self):
+        path = testdata.create_file("slots.conf", [
+            "# a comment",
+            "foo = bar",
+        ])
+        conf = Config(prototype_path=path)
+
+        for cl in conf:
+            self.assertFalse(hasattr(cl, "__dict__"))
+            self.assertFalse(hasattr(cl, "options"))
+            self.assertFalse(cl.modified)
+
+        option = conf["foo"]
+        option.val = "che"
+        self.assertTrue(option.modified)
+        self.assertEqual("foo = che", str(option))
+
+        section = conf.create_section()
+        self.assertEqual(0, len(section.lines))
+
     def test_update_before(self):
         contents = "\n".join([
             "foo = 1",
@@ -363,6 +1209,74 @@ class ConfigTest(TestCase):
         self.assertTrue("bar" in str(conf.lines[1]))
         self.assertTrue("baz" in str(conf.lines[2]))
 
+    def test_batch(self):
+        contents = "\n".join([
+            "foo = 1",
+            "baz = 3",
+            "che = 4",
+        ])
+        path = testdata.create_file("batch.conf", contents)
+        conf = generic.EqualConfig(prototype_path=path)
+
+        with conf.batch() as b:
+            conf["foo"] = 5
+            conf.update_before("baz", ("bar", 2), ("boo", 6))
+            del conf["che"]
+            self.assertTrue("bar" in conf)
+            self.assertEqual(3, len(conf.lines))
+
+        self.assertEqual(
+            ["foo", "bar", "boo", "baz"],
+            [l.name for l in conf.lines]
+        )
+        self.assertEqual(5, conf["foo"].val)
+        self.assertEqual(1, conf.lines.index(conf["bar"]))
+        actions = [(a, n) for a, n, _ in b.changes]
+        self.assertEqual(
+            [("set", "foo"), ("insert", "bar"), ("insert", "boo"), ("delete", "che")],
+            actions
+        )
+
+        with self.assertRaises(RuntimeError):
+            with conf.batch():
+                conf["foo"] = 7
+                conf["zoo"] = 8
+                raise RuntimeError()
+
+        self.assertEqual(5, conf["foo"].val)
+        self.assertFalse("zoo" in conf)
+        self.assertEqual(4, len(conf.lines))
+
+        # deleting an option inserted earlier in the batch drops the insert
+        with conf.batch() as b:
+            conf["new1"] = "a"
+            conf["new2"] = "b"
+            del conf["new1"]
+            self.assertFalse("new1" in conf)
+
+        self.assertFalse("new1" in conf)
+        self.assertEqual("b", conf["new2"].val)
+        self.assertEqual([("insert", "new2")], [(a, n) for a, n, _ in b.changes])
+
+    def test_remove_line(self):
+        path = testdata.create_file("remove.conf", [
+            "# a comment",
+            "foo = 1",
+            "",
+            "bar = 2",
+        ])
+        conf = generic.EqualConfig(prototype_path=path)
+        conf.remove(conf.lines[0])
+        conf.remove(conf.lines[1])
+        self.assertEqual(["foo", "bar"], [l.name for l in conf.lines])
+        self.assertEqual("foo = 1\nbar = 2", str(conf))
+
+        with conf.batch() as b:
+            conf.update("# another comment")
+            conf.remove(conf.lines[0])
+        self.assertEqual([("delete", "foo", None)], b.changes)
+        self.assertEqual("bar = 2\n# another comment", str(conf))
+
     def test_options(self):
         contents = "\n".join([
             "foo=bar",
@@ -388,6 +1302,24 @@ class ConfigTest(TestCase):
 
 
 class SpamAssassinTest(TestCase):
+    def test_local_rules(self):
+        contents = "\n".join([
+            "header LOCAL_FOO Subject =~ /foo/",
+            "describe LOCAL_FOO Subject is foo",
+            "score LOCAL_FOO 1.0",
+            "body LOCAL_BAR /bar/",
+            "meta LOCAL_BOTH (LOCAL_FOO && LOCAL_BAR)",
+            "score LOCAL_BAR 2.0",
+        ])
+        path = testdata.create_file("local.cf", contents)
+        c = spamassassin.Local(prototype_path=path)
+        self.assertEqual("Subject =~ /foo/", c["header LOCAL_FOO"].val)
+        self.assertEqual("Subject is foo", c["describe LOCAL_FOO"].val)
+        self.assertEqual("/bar/", c["body LOCAL_BAR"].val)
+        self.assertEqual("(LOCAL_FOO && LOCAL_BAR)", c["meta LOCAL_BOTH"].val)
+        self.assertEqual("2.0", c["score LOCAL_BAR"].val)
+        self.assertEqual(contents, str(c))
+
     def test_local(self):
         contents = "\n".join([
             "#loadplugin Mail::SpamAssassin::Plugin::DCC",
@@ -406,3 +1338,24 @@ class SpamAssassinTest(TestCase):
         ])
         self.assertEqual(contents, str(c))
 
+    def test_local_plugins(self):
+        path = testdata.create_file("v310.pre", "# plugins")
+        c = spamassassin.Local(prototype_path=path)
+        c.update(
+            ("loadplugin", "Mail::SpamAssassin::Plugin::DCC"),
+            ("loadplugin", "Mail::SpamAssassin::Plugin::Pyzor"),
+            ("loadplugin", "Mail::SpamAssassin::Plugin::Razor2"),
+        )
+        self.assertEqual(
+            [
+                "Mail::SpamAssassin::Plugin::DCC",
+                "Mail::SpamAssassin::Plugin::Pyzor",
+                "Mail::SpamAssassin::Plugin::Razor2",
+            ],
+            [o.val for o in c["loadplugin"]]
+        )
+
+        # the same plugin again doesn't add another line
+        c.update(("loadplugin", "Mail::SpamAssassin::Plugin::Pyzor"))
+        self.assertEqual(3, len(c["loadplugin"]))
+
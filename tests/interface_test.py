@@ -8,6 +8,7 @@ from . import TestCase as BaseTestCase
 #from stockton.path import Filepath, Dirpath
 #from stockton.interface.dkim import DKIM
 from stockton.interface import Postfix, DKIM, SRS, Spam, Razor
+from stockton import cli
 from stockton.path import Filepath, Dirpath
 
 
@@ -57,6 +58,26 @@ class PostfixTest(TestCase):
 
         self.assertFalse(f.exists())
 
+    def test_merged_aliases(self):
+        p = Postfix()
+        p.add_domain("merge1.com", "", "one@example.com", merge=True)
+        p.add_domain("merge2.com", "", "two@example.com")
+        self.assertTrue(p.aliases_f.contains("^@merge1.com\s+one@example.com$"))
+        self.assertTrue(p.aliases_f.contains("^@merge2.com\s+two@example.com$"))
+        self.assertEqual(
+            "hash:{}".format(p.aliases_f),
+            p.main()["virtual_alias_maps"].val
+        )
+        self.assertTrue("two@example.com" in cli.run("postmap -q @merge2.com hash:{}".format(p.aliases_f)))
+
+        p.delete_domain("merge2.com")
+        self.assertFalse(p.aliases_f.contains("merge2.com"))
+        with self.assertRaises(cli.RunError):
+            cli.run("postmap -q @merge2.com hash:{}".format(p.aliases_f))
+
+        p.delete_domain("merge1.com")
+        p.aliases_f.delete()
+
 
 class DKIMTest(TestCase):
     service_class = DKIM
@@ -3,7 +3,8 @@ import time
 
 import testdata
 
-from stockton.path import Dirpath, Filepath, Sentinal
+from stockton.path import Dirpath, Filepath, Sentinal, Snapshots
+from stockton.interface.base import Interface
 
 
 def setUpModule():
@@ -90,3 +91,71 @@ class FilepathTest(TestCase):
         time.sleep(1.1)
         self.assertFalse(f.modified_within(1))
 
+
+class SnapshotsTest(TestCase):
+    def test_create_restore(self):
+        d = testdata.create_dir()
+        foo_f = Filepath(testdata.create_file("foo.conf", "foo", d))
+        bar_f = Filepath(testdata.create_file("bar.conf", "foo", d))
+        s = Snapshots(Dirpath(d, "snapshots").path)
+
+        blob_fs = s.create("base", [foo_f, bar_f, Filepath(d, "missing.conf")])
+        self.assertEqual(2, len(blob_fs))
+        # same contents are only kept once
+        self.assertEqual(blob_fs[0].path, blob_fs[1].path)
+        self.assertEqual(1, len(list(s.blobs_d.files())))
+
+        foo_f.write("changed")
+        s.create("base", [foo_f], ignore_existing=False)
+        s.create("changed", [foo_f])
+        self.assertEqual(2, len(list(s.blobs_d.files())))
+        self.assertEqual(["base", "changed"], s.names())
+
+        # the index is on disk
+        s = Snapshots(s.directory.path)
+        s.restore("base", [foo_f])
+        self.assertEqual("foo", foo_f.contents())
+
+        s.clear("base")
+        self.assertEqual(["changed"], s.names())
+        self.assertEqual(1, len(list(s.blobs_d.files())))
+        self.assertEqual("changed", s.get("changed")[foo_f.path].contents())
+
+        s.clear()
+        self.assertEqual([], s.names())
+        self.assertEqual(0, len(list(s.blobs_d.files())))
+
+    def test_add(self):
+        d = testdata.create_dir()
+        foo_f = Filepath(testdata.create_file("foo.conf", "changed", d))
+        bak_f = Filepath(testdata.create_file("foo.conf.lockdown.bak", "foo", d))
+        s = Snapshots(Dirpath(d, "snapshots").path)
+
+        blob_f = s.add("lockdown", foo_f, bak_f)
+        self.assertEqual("foo", blob_f.contents())
+        s.restore("lockdown")
+        self.assertEqual("foo", foo_f.contents())
+
+    def test_interface(self):
+        d = testdata.create_dir()
+        foo_f = Filepath(testdata.create_file("foo.conf", "foo", d))
+        bar_f = Filepath(testdata.create_file("bar.conf", "bar", d))
+        bak_f = Filepath(testdata.create_file("bar.conf.lockdown.bak", "old", d))
+
+        class Foo(Interface):
+            snapshots_d = Dirpath(d, "snapshots").path
+            def base_configs(self): return [foo_f]
+
+        class Bar(Foo):
+            def base_configs(self): return [bar_f]
+
+        foo, bar = Foo(), Bar()
+        foo.base_create("lockdown")
+        # the older backup is what bar's lockdown snapshot starts from
+        self.assertEqual("old", bar.base_create("lockdown")[0].contents())
+        self.assertFalse(bak_f.exists())
+
+        # clearing one interface leaves the others alone
+        bar.base_clear()
+        self.assertEqual([], bar.base_get("lockdown"))
+        self.assertEqual("foo", foo.base_get("lockdown")[0].contents())